@@ -11,16 +11,52 @@ sys.path.append(this_dir)
 from wext import *
 from past.builtins import xrange
 
+# Stop fitting the maximum entropy weights once the marginals are within this tolerance
+MAXENT_TOLERANCE = 1e-10
+
+# Use sparse adjacency structures in the edge swaps for matrices at least this large
+SPARSE_ADJACENCY_MIN_ENTRIES = 2**27
+
 # Argument parser
 def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-mf', '--mutation_file', type=str, required=True)
     parser.add_argument('-wf', '--weights_file', type=str, required=False, default=None)
     parser.add_argument('-pd', '--permutation_directory', type=str, required=False)
-    parser.add_argument('-np', '--num_permutations', type=int, required=True)
-    parser.add_argument('-si', '--start_index', type=int, required=False, default=1)
+    parser.add_argument('-pa', '--permutation_archive', type=str, required=False, default=None)
+    parser.add_argument('-wm', '--weights_method', type=str, required=False, default='permutation',
+                        choices=['permutation', 'maxent'],
+                        help='Estimate the weights by permuting the matrix, or analytically as the maximum '\
+                             'entropy distribution with the expected marginals.')
+    parser.add_argument('-cwf', '--comparison_weights_file', type=str, required=False, default=None,
+                        help='Report the differences between the computed weights and these weights.')
+    parser.add_argument('-np', '--num_permutations', type=int, required=False, default=None,
+                        help='Number of permutations, or the maximum number if a tolerance is given. '\
+                             'With --update_weights, the number of permutations to add.')
+    parser.add_argument('-tol', '--tolerance', type=float, required=False, default=None,
+                        help='Stop once the maximum relative standard error of the weights is below this tolerance.')
+    parser.add_argument('-bs', '--batch_size', type=int, required=False, default=100,
+                        help='Number of permutations between convergence checks.')
+    parser.add_argument('-si', '--start_index', type=int, required=False, default=1,
+                        help='Index of the first permutation in the sequence of seeds given by --seed.')
+    parser.add_argument('-uw', '--update_weights', action='store_true', default=False, required=False,
+                        help='Add permutations to the counts stored with an existing weights file.')
+    parser.add_argument('-cd', '--checkpoint_dir', type=str, required=False, default=None,
+                        help='Directory to save the counts (and the size of the permutation archive) to after each batch of '\
+                             'permutations, so the run can be resumed.')
+    parser.add_argument('--resume', action='store_true', default=False, required=False,
+                        help='Resume from the checkpoint in --checkpoint_dir, skipping the finished permutations.')
     parser.add_argument('-q', '--swap_multiplier', type=int, required=False, default=100)
+    parser.add_argument('-tm', '--thin_multiplier', type=float, required=False, default=None,
+                        help='Sample permutations from one chain per core, burned in once and then '\
+                             'thinned every thin_multiplier x (number of mutations) swaps.')
     parser.add_argument('-nc', '--num_cores', type=int, required=False, default=1)
+    parser.add_argument('-nt', '--num_threads', type=int, required=False, default=1,
+                        help='Number of threads per core for the edge swaps (-1 for all CPUs).')
+    parser.add_argument('--sparse_adjacency', action='store_true', default=False, required=False)
+    parser.add_argument('-f', '--min_frequency', type=int, required=False, default=1,
+                        help='Only estimate weights for genes mutated in at least this many patients (stored with the weights, '\
+                             'and checked by find_exclusive_sets.py and find_sets.py).')
     parser.add_argument('-s', '--seed', type=int, required=False, default=None)
     parser.add_argument('-v', '--verbose', type=int, required=False, default=1, choices=list(range(5)))
     return parser
@@ -28,54 +64,116 @@ def get_parser():
 def permute_matrices_wrapper(args): 
     return permute_matrices(*args)
 
-def permute_matrices(edge_list, max_swaps, max_tries, seeds, verbose, m, n, num_edges, indexToGene, indexToPatient):
+def permute_matrices(edge_list, max_swaps, max_tries, seeds, verbose, m, n, num_edges, indexToGene, indexToPatient,
+                     thin_swaps=None, keep_permutations=True, row_indices=None, sparse=False, num_threads=1):
     # Initialize our output
     observed     = np.zeros((m, n))
     permutations = []
-    for seed in seeds:
-        # Permute the edge list
-        permuted_edge_list = bipartite_edge_swap(edge_list, max_swaps, max_tries, seed, verbose,
-                                                 m, n, num_edges)
-
-        # Recover the mapping of mutations from the permuted edge list
-        geneToCases  = defaultdict(set)
-        indices = []
-        for edge in permuted_edge_list:
-            gene, patient = indexToGene[edge[0]], indexToPatient[edge[1]]
-            geneToCases[gene].add(patient)
-            indices.append( (edge[0]-1, edge[1]-1) )
 
+    # When we only need the weights, accumulate the counts of the permuted
+    # edges in the (given rows of the) matrix inside the edge swap kernel
+    if not keep_permutations and not thin_swaps:
+        rows = row_indices if row_indices is not None else np.arange(1, m+1)
+        observed[rows-1] = bipartite_edge_swap_counts(edge_list, max_swaps, max_tries, seeds, rows, verbose,
+                                                      int(sparse), num_threads, m, n)
+        return observed/float(len(seeds)), permutations
+
+    # Run a single chain seeded by the first seed, burning in with max_swaps
+    # swaps once and then taking a permuted matrix every thin_swaps swaps
+    if thin_swaps:
+        num_samples = len(seeds)
+        if keep_permutations:
+            permuted_edge_lists = bipartite_edge_swap_chain(edge_list, max_swaps, thin_swaps, max_tries, seeds[0],
+                                                            verbose, int(sparse), m, n, num_samples, num_edges)
+            for k, seed in enumerate(seeds):
+                permuted_edge_list = permuted_edge_lists[:, :, k]
+                observed[permuted_edge_list[:, 0]-1, permuted_edge_list[:, 1]-1] += 1.
+                permutations.append( dict(edge_list=permuted_edge_list, permutation_number=seed) )
+        else:
+            observed += bipartite_edge_swap_chain_counts(edge_list, max_swaps, thin_swaps, max_tries, seeds[0],
+                                                         verbose, int(sparse), m, n, num_samples, num_edges)
+        return observed/float(num_samples), permutations
+
+    # Permute the edge list independently for each seed, running the chains
+    # in threads that write into one preallocated array
+    permuted_edge_lists = np.zeros((num_edges, 2, len(seeds)), dtype=np.int32, order='F')
+    bipartite_edge_swap_batch(permuted_edge_lists, edge_list, max_swaps, max_tries, seeds, verbose,
+                              int(sparse), num_threads, m, n)
+    for k, seed in enumerate(seeds):
         # Record the permutation
-        observed[tuple(zip(*indices))] += 1.
-        geneToCases = dict( (g, list(cases)) for g, cases in geneToCases.items())
-        permutations.append( dict(geneToCases=geneToCases, permutation_number=seed) )
+        permuted_edge_list = permuted_edge_lists[:, :, k]
+        observed[permuted_edge_list[:, 0]-1, permuted_edge_list[:, 1]-1] += 1.
+        permutations.append( dict(edge_list=permuted_edge_list, permutation_number=seed) )
 
     return observed/float(len(seeds)), permutations
 
-def postprocess_weight_matrix(P, r, s):
-    assert np.shape(P)==(len(r), len(s))
+# Convert a (1-indexed) edge list into a boolean genes x patients matrix
+def edge_list_to_matrix(edge_list, m, n):
+    A = np.zeros((m, n), dtype=bool)
+    A[edge_list[:, 0]-1, edge_list[:, 1]-1] = True
+    return A
+
+# Verify that the weights have the observed gene (and patient) marginals, up
+# to the given tolerance
+def check_weight_marginals(P, geneToObserved, patientToObserved, geneToIndex, patientToIndex, tol, check_patients=True):
+    for g, obs in geneToObserved.items():
+        assert( np.abs(P[geneToIndex[g]-1].sum() - obs) < tol)
 
-    # Find indices corresponding to entries of weight matrix with same marginals
-    marginals_to_indices = defaultdict(list)
-    for i, r_i in enumerate(r):
-        for j, s_j in enumerate(s):
-            marginals_to_indices[(r_i, s_j)].append((i, j))
+    if check_patients:
+        for p, obs in patientToObserved.items():
+            assert( np.abs(P[:, patientToIndex[p]-1].sum() - obs) < tol)
 
-    # Average weights over entries of weight matrix with same marginals
-    P_mean = np.zeros(np.shape(P))
-    for marginals, indices in marginals_to_indices.items():
-        mean_value = float(sum(P[i, j] for i, j in indices))/float(len(indices))
-        for i, j in indices:
-            P_mean[i, j] = mean_value
+# Output the weights to file, reporting the differences to the comparison
+# weights if given. The rows/columns preserve the order given by the mutation file.
+def save_weights(args, P):
+    np.save(args.weights_file, P)
 
-    return P_mean
+    if args.comparison_weights_file:
+        comparison = compare_weight_matrices(P, np.load(args.comparison_weights_file))
+        print('* Comparison to {}:'.format(args.comparison_weights_file))
+        for key in ['max_abs_diff', 'mean_abs_diff', 'max_rel_diff', 'correlation']:
+            print('\t- {}: {}'.format(key, comparison[key]))
+
+# Save a batch of permuted matrices to the permutation directory (one JSON
+# file each) and/or append them to the permutation archive
+def save_permutations(args, permutations, params, indexToGene, indexToPatient, m, n):
+    if args.permutation_directory:
+        output_prefix = args.permutation_directory + '/permuted-mutations-{}.json'
+        for permutation in permutations:
+            # Recover the mapping of mutations from the permuted edge list
+            geneToCases = defaultdict(list)
+            for i, j in permutation['edge_list']:
+                geneToCases[indexToGene[i]].append(indexToPatient[j])
+
+            # Output in adjacency list format
+            with open(output_prefix.format(permutation['permutation_number']), 'w') as OUT:
+                output = dict(geneToCases=geneToCases, params=params,
+                              permutation_number=permutation['permutation_number'])
+                json.dump( output, OUT )
+
+    if args.permutation_archive:
+        seeds = [ permutation['permutation_number'] for permutation in permutations ]
+        matrices = ( edge_list_to_matrix(permutation['edge_list'], m, n) for permutation in permutations )
+        append_permutation_archive(args.permutation_archive, seeds, matrices)
 
 def run( args ):
     # Do some additional argument checking
-    if not args.weights_file and not args.permutation_directory:
-        sys.stderr.write('You must set the weights file or permutation directory, '\
+    if not args.weights_file and not args.permutation_directory and not args.permutation_archive:
+        sys.stderr.write('You must set the weights file, permutation directory, or permutation archive, '\
                          'otherwise nothing will be output.')
         sys.exit(1)
+    if args.weights_method == 'maxent':
+        if args.permutation_directory or args.permutation_archive or args.update_weights or not args.weights_file:
+            sys.stderr.write('The maxent method only computes the weights file.')
+            sys.exit(1)
+    elif args.num_permutations is None:
+        sys.stderr.write('You must set the number of permutations.')
+        sys.exit(1)
+    if args.update_weights and args.weights_file and os.path.isfile(args.weights_file) and \
+       not os.path.isfile(weight_counts_file(args.weights_file)):
+        sys.stderr.write('Cannot update weights file {}: it has no counts file {} to add the permutations to.'.format(
+                         args.weights_file, weight_counts_file(args.weights_file)))
+        sys.exit(1)
 
     # Load mutation data
     if args.verbose > 0:
@@ -98,90 +196,214 @@ def run( args ):
 
     edge_list = np.array(sorted(edges), dtype=np.int)
 
+    m = len(all_genes)
+    n = len(patients)
+    r = np.bincount(edge_list[:, 0]-1, minlength=m)
+    s = np.bincount(edge_list[:, 1]-1, minlength=n)
+
+    # Fit the maximum entropy weights directly from the marginals
+    if args.weights_method == 'maxent':
+        if args.verbose > 0:
+            print('* Fitting maximum entropy weights...')
+
+        P = maxent_weight_matrix(r, s, tol=MAXENT_TOLERANCE)
+
+        # Verify the weights, allowing for the tolerance of the fit
+        check_weight_marginals(P, geneToObserved, patientToObserved, geneToIndex, patientToIndex, 1e2*MAXENT_TOLERANCE)
+
+        P[P == 0] = np.finfo(np.float64).eps
+        save_weights(args, P)
+        if os.path.isfile(weight_counts_file(args.weights_file)):
+            os.remove(weight_counts_file(args.weights_file))
+        return
+
     # Run the bipartite edge swaps
     if args.verbose > 0:
         print('* Permuting matrices...')
 
-    m = len(all_genes)
-    n = len(patients)
     num_edges = len(edges)
     max_swaps = int(args.swap_multiplier*num_edges)
     max_tries = 10**9
-    if args.seed is not None:
-        random.seed(args.seed)
-    seeds = random.sample(xrange(1, 2*10**9), args.num_permutations)
+    thin_swaps = max(int(args.thin_multiplier*num_edges), 1) if args.thin_multiplier else None
+    keep_permutations = bool(args.permutation_directory or args.permutation_archive)
+
+    # Store the permuted edges in a hash table instead of a genes x patients
+    # adjacency matrix for large matrices (the permutations are the same)
+    sparse = args.sparse_adjacency or m*n >= SPARSE_ADJACENCY_MIN_ENTRIES
+
+    # Restrict the weights to genes mutated in the minimum number of patients
+    row_indices = np.array([ geneToIndex[g] for g in all_genes if geneToObserved.get(g, 0) >= args.min_frequency ], dtype=int)
+    counted_genes = set( all_genes[i-1] for i in row_indices )
+    is_restricted = any( g not in counted_genes for g, obs in geneToObserved.items() if obs > 0 )
+
+    # Start from the counts of an existing weights file, continuing its
+    # sequence of seeds after the permutations it already used
+    counts, num_permutations = np.zeros((m, n)), 0
+    start_index, seed = args.start_index, args.seed
+    if args.update_weights and args.weights_file and os.path.isfile(weight_counts_file(args.weights_file)):
+        weight_counts = load_weight_counts(args.weights_file)
+        if weight_counts['genes'] != list(all_genes) or weight_counts['patients'] != list(patients):
+            raise ValueError('Weights file {} has different genes or patients'.format(args.weights_file))
+        if (weight_counts['swap_multiplier'], weight_counts['thin_multiplier'], weight_counts['min_frequency']) != \
+           (args.swap_multiplier, args.thin_multiplier, args.min_frequency):
+            raise ValueError('Weights file {} was computed with different parameters'.format(args.weights_file))
+        counts, num_permutations = weight_counts['counts'], weight_counts['num_permutations']
+        start_index = num_permutations + 1
+        if seed is None:
+            seed = weight_counts['seed']
+        if args.verbose > 0:
+            print('\t- Updating weights from {} permutations'.format(num_permutations))
+
+    # The seeds are a prefix-consistent sequence, so the permutations from
+    # start_index onwards are the same as in a longer run with the same seed
+    if seed is not None:
+        random.seed(seed)
+    seeds = random.sample(xrange(1, 2*10**9), start_index-1+args.num_permutations)[start_index-1:]
 
     # Run the bipartite edge swaps in parallel if more than one core indicated
     num_cores = min(args.num_cores if args.num_cores != -1 else mp.cpu_count(), args.num_permutations)
+    num_threads = args.num_threads if args.num_threads != -1 else mp.cpu_count()
     if num_cores != 1:
         pool = mp.Pool(num_cores)
         map_fn = pool.map
     else:
         map_fn = map
 
-    wrapper_args = [ (edge_list, max_swaps, max_tries, seeds[i::num_cores], 0, m,
-                      n, num_edges, indexToGene, indexToPatient) for i in range(num_cores) ]
-    results = map_fn(permute_matrices_wrapper, wrapper_args)
+    def permute(batch_seeds):
+        batch_cores = min(num_cores, len(batch_seeds))
+        core_seeds = [ batch_seeds[i::batch_cores] for i in range(batch_cores) ]
+        wrapper_args = [ (edge_list, max_swaps, max_tries, core_seeds[i], 0, m,
+                          n, num_edges, indexToGene, indexToPatient, thin_swaps, keep_permutations, row_indices, sparse,
+                          num_threads)
+                        for i in range(batch_cores) ]
+        results = list(map_fn(permute_matrices_wrapper, wrapper_args))
+
+        # Sum the counts of the permuted edges over the cores
+        batch_counts = np.add.reduce([ observed*len(core_seeds[i]) for i, (observed, _) in enumerate(results) ])
+        batch_permutations = [ permutation for _, permutation_list in results for permutation in permutation_list ]
+        return batch_counts, batch_permutations
+
+    # Permute the matrices in batches. If a tolerance is given, we stop once
+    # the class means of the weights (see postprocess_weight_matrix) have
+    # relative standard error below the tolerance across the batches.
+    _, row_classes, _, col_classes = marginal_classes(r, s)
+    sizes = class_sizes(row_classes, col_classes)
+
+    batch_size = args.batch_size if args.tolerance or args.checkpoint_dir else args.num_permutations
+    batch_class_means = []
+    first_batch, converged = 0, False
+
+    # The permuted matrices are saved after each batch, appending to an
+    # existing archive of the same genes and patients
+    if args.permutation_archive:
+        if is_permutation_archive(args.permutation_archive):
+            header, _ = load_permutation_archive(args.permutation_archive)
+            if header['genes'] != list(all_genes) or header['patients'] != list(patients):
+                raise ValueError('Permutation archive {} has different genes or patients'.format(args.permutation_archive))
+        else:
+            create_permutation_archive(args.permutation_archive, all_genes, patients, params)
+        num_archived = len(load_permutation_archive(args.permutation_archive)[1])
+
+    # With a checkpoint directory, we save the counts (and the seeds, so the
+    # run can be resumed without --seed) after each batch, and start from the
+    # saved counts when resuming. The checkpoint also records the number of
+    # permutations in the archive, which is truncated back to it when
+    # resuming, dropping the permutations of an unfinished batch. Permutation
+    # files of an unfinished batch are overwritten by the same permutations.
+    if args.checkpoint_dir:
+        init_checkpoint_dir(args.checkpoint_dir, args.resume)
+        checkpoint_file = os.path.join(args.checkpoint_dir, 'weights.npz')
+        checkpoint_params = dict(genes=checkpoint_digest(all_genes), patients=checkpoint_digest(patients),
+                                 edges=checkpoint_digest([edge_list]), num_permutations=args.num_permutations,
+                                 tolerance=args.tolerance, batch_size=batch_size, swap_multiplier=args.swap_multiplier,
+                                 thin_multiplier=args.thin_multiplier, min_frequency=args.min_frequency,
+                                 permutation_directory=args.permutation_directory,
+                                 permutation_archive=args.permutation_archive)
+        def save_weights_checkpoint(num_batches):
+            save_checkpoint(checkpoint_file, checkpoint_params, counts=counts, num_permutations=num_permutations,
+                            seeds=seeds, seed=-1 if seed is None else seed, num_batches=num_batches, converged=converged,
+                            batch_class_means=np.array(batch_class_means).reshape((-1,) + sizes.shape),
+                            num_archived=num_archived if args.permutation_archive else -1)
+
+        checkpoint = load_checkpoint(checkpoint_file, checkpoint_params)
+        if checkpoint is not None:
+            counts, num_permutations = checkpoint['counts'], int(checkpoint['num_permutations'])
+            seeds, first_batch = checkpoint['seeds'].tolist(), int(checkpoint['num_batches'])*batch_size
+            batch_class_means, converged = list(checkpoint['batch_class_means']), bool(checkpoint['converged'])
+            seed = None if checkpoint['seed'] == -1 else int(checkpoint['seed'])
+            if args.permutation_archive:
+                num_archived = int(checkpoint['num_archived'])
+                truncate_permutation_archive(args.permutation_archive, num_archived)
+            if args.verbose > 0:
+                print('\t- Resuming from {} permutations'.format(num_permutations))
+
+        # Record the initial size of the archive, in case the first batch is
+        # only partly appended to it
+        elif args.permutation_archive:
+            save_weights_checkpoint(0)
+
+    relative_error = max_relative_error(batch_class_means)
+    for start in range(first_batch, args.num_permutations if not converged else first_batch, batch_size):
+        batch_seeds = seeds[start:start+batch_size]
+        batch_counts, batch_permutations = permute(batch_seeds)
+        counts += batch_counts
+        num_permutations += len(batch_seeds)
+        if keep_permutations:
+            save_permutations(args, batch_permutations, params, indexToGene, indexToPatient, m, n)
+            num_archived += len(batch_permutations) if args.permutation_archive else 0
+
+        if args.tolerance:
+            batch_class_means.append( class_sums(batch_counts, row_classes, col_classes)/(sizes*float(len(batch_seeds))) )
+            relative_error = max_relative_error(batch_class_means)
+            if args.verbose > 1:
+                print('\t- {} permutations: maximum relative error {}'.format(num_permutations, relative_error))
+            converged = relative_error < args.tolerance
+
+        if args.checkpoint_dir:
+            save_weights_checkpoint(start//batch_size + 1)
+        if converged:
+            break
 
     if num_cores != 1:
         pool.close()
         pool.join()
 
+    if args.verbose > 0 and args.tolerance:
+        print('* Used {} permutations (maximum relative error {})'.format(num_permutations, relative_error))
+
     # Create the weights file
     if args.weights_file:
         if args.verbose > 0:
             print('* Saving weights file...')
 
         # Allow for small accumulated numerical errors
-        tol = 1e3*max(m, n)*args.num_permutations*np.finfo(np.float64).eps
+        tol = 1e3*max(m, n)*num_permutations*np.finfo(np.float64).eps
 
         # Merge the observeds
-        observeds = [ observed for observed, _ in results ]
-        P = np.add.reduce(observeds) / float(len(observeds))
+        P = counts / float(num_permutations)
 
-        # Verify the weights
+        # Genes mutated in fewer than the minimum number of patients were not
+        # counted, so we spread their mutations uniformly across patients. Only
+        # the gene marginals are then preserved.
         for g, obs in geneToObserved.items():
-            assert( np.abs(P[geneToIndex[g]-1].sum() - obs) < tol)
-
-        for p, obs in patientToObserved.items():
-            assert( np.abs(P[:, patientToIndex[p]-1].sum() - obs) < tol)
+            if g not in counted_genes:
+                P[geneToIndex[g]-1] = obs/float(n)
 
-        # Construct mutation matrix to compute marginals
-        A = np.zeros(np.shape(P), dtype=np.int)
-        for i, j in edge_list:
-            A[i-1, j-1] = 1
-        r = np.sum(A, 1)
-        s = np.sum(A, 0)
+        # Verify the weights
+        check_weight_marginals(P, geneToObserved, patientToObserved, geneToIndex, patientToIndex, tol, not is_restricted)
 
         # Post-process weight matrix to assign same weight to entries with same marginals
-        P = postprocess_weight_matrix(P, r, s)
+        P, _ = postprocess_weight_matrix(P, r, s)
 
         # Verify the weights again
-        for g, obs in geneToObserved.items():
-            assert( np.abs(P[geneToIndex[g]-1].sum() - obs) < tol)
-
-        for p, obs in patientToObserved.items():
-            assert( np.abs(P[:, patientToIndex[p]-1].sum() - obs) < tol)
+        check_weight_marginals(P, geneToObserved, patientToObserved, geneToIndex, patientToIndex, tol, not is_restricted)
  
         # Add pseudocounts to entries with no mutations observed; unlikely or impossible after post-processing step
-        P[P == 0] = 1./(2. * args.num_permutations)
+        P[P == 0] = 1./(2. * num_permutations)
 
-        # Output to file.
-        # The rows/columns preserve the order given by the mutation file.
-        np.save(args.weights_file, P)
-
-    # Save the permuted mutation data
-    if args.permutation_directory:
-        output_prefix = args.permutation_directory + '/permuted-mutations-{}.json'
-        if args.verbose > 0:
-            print('* Saving permuted mutation data...')
-
-        for _, permutation_list in results:
-            for permutation in permutation_list:
-                # Output in adjacency list format
-                with open(output_prefix.format(permutation['permutation_number']), 'w') as OUT:
-                    permutation['params'] = params
-                    json.dump( permutation, OUT )
+        save_weights(args, P)
+        save_weight_counts(args.weights_file, counts, num_permutations, all_genes, patients, seed,
+                           args.swap_multiplier, args.thin_multiplier, args.min_frequency)
 
 if __name__ == '__main__': 
     run( get_parser().parse_args(sys.argv[1:]) )
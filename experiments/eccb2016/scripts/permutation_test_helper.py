@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 # Load required modules
-import sys, os, argparse
+import sys, os, argparse, numpy as np
 from itertools import combinations
 
 # Parse arguments
@@ -30,7 +30,8 @@ if args.verbose > 0:
 mutation_data = load_mutation_data( args.mutation_file, args.min_freq )
 genes, all_genes, patients, geneToCases, _, params, _ = mutation_data
 num_patients = len(patients)
-sets = list( frozenset(t) for t in combinations(genes, args.gene_set_size) )
+genes = sorted(genes)
+sets = np.array(list(combinations(range(len(genes)), args.gene_set_size)), dtype=np.int32)
 
 if args.verbose > 0: 
 	print('\t- Testing {} sets of size k={}'.format(len(sets), args.gene_set_size))
@@ -43,10 +44,10 @@ permuted_files = get_permuted_files([args.input_directory], args.num_permutation
 if args.verbose > 0: 
 	print('\t- Testing {} files'.format(len(permuted_files)))
     
-setToPval, setToRuntime, setToFDR, setToObs = rce_permutation_test( sets, geneToCases, num_patients, permuted_files, 1, 0 )
+results = rce_permutation_test( genes, sets, geneToCases, num_patients, permuted_files, 1, 0 )
 
 # Output to file
 args.output_prefix += '-%s' % job_id
 args.test = 'RCE'
 args.json_format = True
-output_enumeration_table( args, args.gene_set_size, setToPval, setToRuntime, setToFDR, setToObs )
+output_enumeration_table( args, args.gene_set_size, results )
@@ -86,5 +86,6 @@ print('* Outputting to file...')
 k                  = len(tested_sets[0])
 args.json_format   = True
 args.test          = 'RCE'
-output_enumeration_table( args, k, setToPval, setToRuntime, setToFDR, setToObs )
+genes              = sorted(set( g for M in tested_sets for g in M ))
+output_enumeration_table( args, k, results_from_dicts(genes, setToPval, setToRuntime, setToFDR, setToObs) )
 
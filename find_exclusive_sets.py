@@ -5,6 +5,7 @@ import sys, os, argparse, numpy as np, json
 from itertools import combinations
 from collections import defaultdict
 from time import time
+from scipy.special import comb
 
 # Load WExT, ensuring that it is in the path (unless this script was moved)
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
@@ -21,13 +22,55 @@ def get_parser():
     parser.add_argument('-v', '--verbose', type=int, required=False, default=1, choices=list(range(5)))
     parser.add_argument('-r', '--report_invalids', action='store_true', default=False, required=False)
     parser.add_argument('--json_format', action='store_true', default=False, required=False)
+    parser.add_argument('--binary_format', action='store_true', default=False, required=False,
+                        help='Output a chunked NumPy (.npz) results archive.')
+    parser.add_argument('-pc', '--pvalue_cache', type=str, required=False, default=None,
+                        help='SQLite file of P-values to reuse across runs (created if it does not exist).')
+    parser.add_argument('-sh', '--shard', type=str, required=False, default=None,
+                        help='Only test shard i/n (with 1 <= i <= n) of the gene sets, e.g. for grid runs. '\
+                             'Merge the shard outputs with merge_results.py.')
+    parser.add_argument('-nf', '--network_file', type=str, required=False, default=None,
+                        help='Edge list of an interaction network. Only enumerate the gene sets that are '\
+                             'connected in the network.')
+    parser.add_argument('-cg', '--collapse_genes', action='store_true', default=False, required=False,
+                        help='Only test one gene of each class of genes with the same mutations (and weights) '\
+                             'when enumerating, and expand the results to the other genes of the classes.')
+    parser.add_argument('-cd', '--checkpoint_dir', type=str, required=False, default=None,
+                        help='Directory to save checkpoints to while enumerating, so the run can be resumed.')
+    parser.add_argument('-cs', '--checkpoint_size', type=int, required=False, default=None,
+                        help='Number of gene sets (or permuted matrices with RCE) tested between checkpoints.')
+    parser.add_argument('--resume', action='store_true', default=False, required=False,
+                        help='Resume from the checkpoints in --checkpoint_dir, skipping the finished work.')
 
     # Search strategy
-    parser.add_argument('-s', '--search_strategy', type=str, choices=['Enumerate', 'MCMC'], default='MCMC', required=False)
+    parser.add_argument('-s', '--search_strategy', type=str, choices=['Enumerate', 'Apriori', 'MCMC', 'MCMC-PT'], default='MCMC', required=False)
     parser.add_argument('-ks', '--gene_set_sizes', nargs="*", type=int, required=True)
-    parser.add_argument('-N', '--num_iterations', type=int, default=pow(10, 3))
+    parser.add_argument('-tk', '--top_k', type=int, default=None, required=False,
+                        help='Only keep the K sets with the smallest P-values when enumerating (RE and WRE).')
+    parser.add_argument('-pt', '--pvalue_threshold', type=float, default=None, required=False,
+                        help='Only keep sets with P-value at most this threshold when enumerating (RE and WRE).')
+    parser.add_argument('-at', '--apriori_threshold', type=float, default=None, required=False,
+                        help='With Apriori, only build larger sets from sets with P-value at most this threshold '\
+                             '(by default, from all sets whose genes have exclusive mutations).')
+    parser.add_argument('-N', '--num_iterations', type=int, default=pow(10, 3),
+                        help='Number of MCMC iterations per chain, or the maximum number if a convergence threshold is given.')
     parser.add_argument('-nc', '--num_chains', type=int, default=1)
     parser.add_argument('-sl', '--step_length', type=int, default=100)
+    parser.add_argument('-sgl', '--segment_length', type=int, default=None, required=False,
+                        help='Number of iterations the MCMC chains run in parallel before merging their caches '\
+                             'and checking convergence.')
+    parser.add_argument('-rt', '--rhat_threshold', type=float, default=None, required=False,
+                        help='Stop the MCMC once the Gelman-Rubin R-hat of the collection weights and of the '\
+                             'top collection frequencies are below this threshold.')
+    parser.add_argument('-ess', '--min_ess', type=float, default=None, required=False,
+                        help='Stop the MCMC once the effective sample size of the collection weights is at least this.')
+    parser.add_argument('-ntm', '--num_temperatures', type=int, default=4, required=False,
+                        help='Number of replicas in each chain with MCMC-PT.')
+    parser.add_argument('-ht', '--max_temperature', type=float, default=8., required=False,
+                        help='Temperature of the hottest replica with MCMC-PT (temperatures are spaced geometrically from 1).')
+    parser.add_argument('-swi', '--swap_interval', type=int, default=None, required=False,
+                        help='Number of iterations between swaps of the replicas with MCMC-PT (by default, a tenth '\
+                             'of the iterations).')
     parser.add_argument('-a', '--alpha', type=float, default=2., required=False, help='CoMEt parameter alpha.')
     parser.add_argument('--mcmc_seed', type=int, default=int(time()), required=False)
 
@@ -48,15 +91,20 @@ def get_parser():
     return parser
 
 def get_permuted_files(permuted_matrix_directories, num_permutations):
-    # Group and restrict the list of files we're testing
+    # Group and restrict the list of files we're testing. Permutation archives
+    # are referenced by (archive, index) pairs instead of one file per matrix.
     permuted_directory_files = []
     for permuted_matrix_dir in permuted_matrix_directories:
-        files = sorted(os.listdir(permuted_matrix_dir))
-        permuted_matrices = [ '{}/{}'.format(permuted_matrix_dir, f) for f in files if f.lower().endswith('.json') ]
+        if is_permutation_archive(permuted_matrix_dir):
+            _, records = load_permutation_archive(permuted_matrix_dir)
+            permuted_matrices = [ (permuted_matrix_dir, i) for i in range(len(records)) ]
+        else:
+            files = sorted(os.listdir(permuted_matrix_dir))
+            permuted_matrices = [ '{}/{}'.format(permuted_matrix_dir, f) for f in files if f.lower().endswith('.json') ]
         permuted_directory_files.append( permuted_matrices[:num_permutations] )
     assert( len(files) == num_permutations for files in permuted_directory_files )
 
-    return zip(*permuted_directory_files)
+    return list(zip(*permuted_directory_files))
 
 # Load a list of weights files, merging them at the patient and gene level.
 # Note that if a (gene, patient) pair is present in more than one file, it will
@@ -118,10 +166,19 @@ def run( args ):
     # Provide additional checks on arguments
     if args.test == 'RCE':
         assert( len(args.mutation_files) == len(args.permuted_matrix_directories ) )
-        assert( args.search_strategy != "MCMC" ) # MCMC is not implemented for RCE
+        assert( args.search_strategy not in ("MCMC", "MCMC-PT") ) # MCMC is not implemented for RCE
     elif args.test == 'WRE':
         assert( len(args.mutation_files) == len(args.weights_files) )
 
+        # The weights are only estimated for genes mutated in at least the minimum
+        # frequency they were computed with, so it cannot be larger than ours
+        for weights_file in args.weights_files:
+            min_frequency = weights_min_frequency(weights_file)
+            if min_frequency is not None and min_frequency > args.min_frequency:
+                sys.stderr.write('Weights file {} only has weights for genes mutated in >={} patients, so -f/--min_frequency '\
+                                 'must be at least {}.\n'.format(weights_file, min_frequency, min_frequency))
+                sys.exit(1)
+
     # Load the mutation data
     if args.verbose > 0:
         print(('-' * 30), 'Input Mutation Data', ('-' * 29))
@@ -166,6 +223,12 @@ def run( args ):
     else:
         geneToP = None
 
+    # Open the persistent P-value cache (if necessary)
+    if args.pvalue_cache and test != RCE:
+        cache = pvalue_cache(args.pvalue_cache, geneToCases, num_patients, test, nameToMethod[args.method], geneToP)
+    else:
+        cache = None
+
     # Find the permuted matrices (if necessary)
     if test == RCE:
         permuted_files = get_permuted_files(args.permuted_matrix_directories, args.num_permutations)
@@ -176,29 +239,120 @@ def run( args ):
     if args.search_strategy == 'Enumerate':
         if args.verbose > 0: 
             print(('-' * 31), 'Enumerating Sets', ('-' * 31))
+        genes = sorted(genes)
+        if args.shard and (args.top_k is not None or args.pvalue_threshold is not None):
+            raise NotImplementedError('Sharding is not implemented with --top_k or --pvalue_threshold.')
+        if args.checkpoint_dir and (args.top_k is not None or args.pvalue_threshold is not None):
+            raise NotImplementedError('Checkpoints are not implemented with --top_k or --pvalue_threshold.')
+        if args.network_file and (args.collapse_genes or args.top_k is not None or args.pvalue_threshold is not None):
+            raise NotImplementedError('Network enumeration is not implemented with --collapse_genes, --top_k or --pvalue_threshold.')
+
+        # Test the sets of representatives of the classes of genes with the
+        # same mutations (and weights), and expand the results to all genes
+        representativeToMembers, test_genes = None, genes
+        if args.collapse_genes:
+            if test == RCE or args.top_k is not None or args.pvalue_threshold is not None:
+                raise NotImplementedError('Collapsing genes is only implemented for RE and WRE without --top_k or --pvalue_threshold.')
+            representativeToMembers = gene_equivalence_classes(genes, geneToCases, geneToP)
+            test_genes = sorted(representativeToMembers.keys())
+            if args.verbose > 0:
+                print('- Collapsed {} genes into {} classes with the same mutations'.format(len(genes), len(test_genes)))
+
+        # Only enumerate the sets connected in the network
+        if args.network_file:
+            neighbors = network_neighbors(genes, load_network(args.network_file))
+            if args.verbose > 0:
+                print('- Genes in the network: {}'.format(sum( 1 for n in neighbors if n )))
+
         for k in set( args.gene_set_sizes ): # we don't need to enumerate the same size more than once
-            # Create a list of sets to test
-            sets = list( frozenset(t) for t in combinations(genes, k) )
+            # Test the sets as they are generated, keeping only the best ones
+            if test != RCE and (args.top_k is not None or args.pvalue_threshold is not None):
+                if args.verbose  > 0:
+                    print('k={}: {} sets...'.format(k, comb(len(genes), k, exact=True)))
+                method = nameToMethod[args.method]
+                results = bounded_test_sets(genes, k, geneToCases, num_patients, method, test, geneToP, args.num_cores,
+                                            verbose=args.verbose, top_k=args.top_k,
+                                            pvalue_threshold=args.pvalue_threshold, cache=cache)
+                output_enumeration_table( args, k, results )
+                continue
+
+            # Create a matrix of the sets to test (in the given shard), as
+            # indices into the genes
+            if args.network_file:
+                ranks = shard_ranks(num_connected_subgraphs(neighbors, k), parse_shard(args.shard)) if args.shard else ()
+                sets = connected_set_matrix(neighbors, k, *ranks)
+            elif args.shard:
+                ranks = shard_ranks(comb(len(test_genes), k, exact=True), parse_shard(args.shard))
+                sets = combination_matrix(len(test_genes), k, *ranks)
+            else:
+                sets = np.array(list(combinations(range(len(test_genes)), k)), dtype=np.int32).reshape(-1, k)
             num_sets = len(sets)
 
             if args.verbose  > 0: 
                 print('k={}: {} sets...'.format(k, num_sets))
+
+            # Save checkpoints for each set size in its own directory
+            checkpoint_params = dict()
+            if args.checkpoint_dir:
+                checkpoint_params['checkpoint_dir'] = os.path.join(args.checkpoint_dir, 'k{}'.format(k))
+                init_checkpoint_dir(checkpoint_params['checkpoint_dir'], args.resume)
+                if args.checkpoint_size:
+                    checkpoint_params['checkpoint_size'] = args.checkpoint_size
+
             if test == RCE:
                 # Run the permutational
-                setToPval, setToRuntime, setToFDR, setToObs = rce_permutation_test( sets, geneToCases, num_patients, permuted_files, args.num_cores, args.verbose )
+                results = rce_permutation_test( genes, sets, geneToCases, num_patients, permuted_files, args.num_cores, args.verbose,
+                                                **checkpoint_params )
+            elif args.binary_format:
+                # Run the test, writing the results archive as the sets are tested
+                method = nameToMethod[args.method]
+                archive_file = enumeration_archive_file(args, k)
+                create_results_archive(archive_file, genes, vars(args))
+                test_sets(test_genes, sets, geneToCases, num_patients, method, test, geneToP, args.num_cores,
+                          verbose=args.verbose, report_invalids=args.report_invalids, cache=cache,
+                          representativeToMembers=representativeToMembers, archive_file=archive_file, **checkpoint_params)
+                continue
             else:
                 # Run the test
                 method = nameToMethod[args.method]
-                setToPval, setToRuntime, setToFDR, setToObs = test_sets(sets, geneToCases, num_patients, method, test, geneToP, args.num_cores,
-                                                                        verbose=args.verbose, report_invalids=args.report_invalids)
-            output_enumeration_table( args, k, setToPval, setToRuntime, setToFDR, setToObs )
+                results = test_sets(test_genes, sets, geneToCases, num_patients, method, test, geneToP, args.num_cores,
+                                    verbose=args.verbose, report_invalids=args.report_invalids, cache=cache,
+                                    representativeToMembers=representativeToMembers, **checkpoint_params)
+            output_enumeration_table( args, k, results )
+
+    # Apriori enumeration, building the sets of each size from the sets of
+    # the previous size
+    elif args.search_strategy == 'Apriori':
+        if test == RCE or args.shard or args.checkpoint_dir or args.collapse_genes or \
+           args.top_k is not None or args.pvalue_threshold is not None:
+            raise NotImplementedError('Apriori is only implemented for RE and WRE, without sharding, checkpoints, '\
+                                      'collapsing genes, --top_k or --pvalue_threshold.')
+        if args.network_file:
+            raise NotImplementedError('Network enumeration is only implemented with Enumerate.')
+        if args.verbose > 0:
+            print(('-' * 31), 'Apriori Enumeration', ('-' * 28))
+        method = nameToMethod[args.method]
+        ksToResults = apriori_test_sets(sorted(genes), set(args.gene_set_sizes), geneToCases, num_patients, method, test,
+                                        geneToP, args.num_cores, verbose=args.verbose, report_invalids=args.report_invalids,
+                                        cache=cache, pvalue_threshold=args.apriori_threshold)
+        for k, results in ksToResults.items():
+            output_enumeration_table( args, k, results )
 
     # MCMC
-    elif args.search_strategy == 'MCMC':
+    elif args.search_strategy in ('MCMC', 'MCMC-PT'):
+        if args.shard or args.checkpoint_dir or args.network_file:
+            raise NotImplementedError('Sharding, checkpoints and networks are only implemented when enumerating.')
         method = nameToMethod[args.method]
-        mcmc_params = dict(annotations=annotations, niters=args.num_iterations, nchains=args.num_chains, step_len=args.step_length, verbose=args.verbose, seed=args.mcmc_seed)
-        setsToFreq, setToPval, setToObs = mcmc(args.gene_set_sizes, geneToCases, num_patients, method, test, geneToP, **mcmc_params)
-        output_mcmc(args, setsToFreq, setToPval, setToObs)
+        if args.search_strategy == 'MCMC-PT' and args.num_temperatures > 1:
+            temperatures = [ args.max_temperature**(i/(args.num_temperatures-1.)) for i in range(args.num_temperatures) ]
+        else:
+            temperatures = None
+        mcmc_params = dict(annotations=annotations, niters=args.num_iterations, nchains=args.num_chains, step_len=args.step_length, verbose=args.verbose, seed=args.mcmc_seed,
+                           num_cores=args.num_cores, segment_len=args.segment_length, rhat_threshold=args.rhat_threshold,
+                           min_ess=args.min_ess, temperatures=temperatures, swap_interval=args.swap_interval,
+                           cache=cache)
+        collections, results, diagnostics = mcmc(args.gene_set_sizes, geneToCases, num_patients, method, test, geneToP, **mcmc_params)
+        output_mcmc(args, collections, results, diagnostics)
     else:
         raise NotImplementedError("Strategy '{}' not implemented.".format(args.strategy))
 
@@ -5,6 +5,7 @@ import sys, os, argparse, numpy as np, json
 from itertools import combinations
 from collections import defaultdict
 from time import time
+from scipy.special import comb
 
 # Load WExT, ensuring that it is in the path (unless this script was moved)
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
@@ -27,18 +28,43 @@ def get_parser():
     parser.add_argument('-v', '--verbose', type=int, required=False, default=1, choices=list(range(5)) )
     parser.add_argument('-r', '--report_invalids', action='store_true', default=False, required=False)
     parser.add_argument('--json_format', action='store_true', default=False, required=False)
+    parser.add_argument('--binary_format', action='store_true', default=False, required=False,
+                        help='Output a chunked NumPy (.npz) results archive.')
+    parser.add_argument('-pc', '--pvalue_cache', type=str, required=False, default=None,
+                        help='SQLite file of P-values to reuse across runs (created if it does not exist).')
+    parser.add_argument('-sh', '--shard', type=str, required=False, default=None,
+                        help='Only test shard i/n (with 1 <= i <= n) of the gene sets, e.g. for grid runs. '\
+                             'Merge the shard outputs with merge_results.py.')
+    parser.add_argument('-nf', '--network_file', type=str, required=False, default=None,
+                        help='Edge list of an interaction network. Only enumerate the gene sets that are '\
+                             'connected in the network.')
+    parser.add_argument('-oc', '--only_cooccurring', action='store_true', default=False, required=False,
+                        help='With a co-occurrence statistic, only test the sets with a co-occurring patient, found '\
+                             'from an index of the genes mutated in each patient. The other sets have P-value 1, '\
+                             'and are counted in the FDRs but not output.')
+    parser.add_argument('-cd', '--checkpoint_dir', type=str, required=False, default=None,
+                        help='Directory to save checkpoints to while enumerating, so the run can be resumed.')
+    parser.add_argument('-cs', '--checkpoint_size', type=int, required=False, default=None,
+                        help='Number of gene sets (or permuted matrices with RCE) tested between checkpoints.')
+    parser.add_argument('--resume', action='store_true', default=False, required=False,
+                        help='Resume from the checkpoints in --checkpoint_dir, skipping the finished work.')
     return parser
 
 def get_permuted_files(permuted_matrix_directories, num_permutations):
-    # Group and restrict the list of files we're testing
+    # Group and restrict the list of files we're testing. Permutation archives
+    # are referenced by (archive, index) pairs instead of one file per matrix.
     permuted_directory_files = []
     for permuted_matrix_dir in permuted_matrix_directories:
-        files = sorted(os.listdir(permuted_matrix_dir))
-        permuted_matrices = [ '{}/{}'.format(permuted_matrix_dir, f) for f in files if f.lower().endswith('.json') ]
+        if is_permutation_archive(permuted_matrix_dir):
+            _, records = load_permutation_archive(permuted_matrix_dir)
+            permuted_matrices = [ (permuted_matrix_dir, i) for i in range(len(records)) ]
+        else:
+            files = sorted(os.listdir(permuted_matrix_dir))
+            permuted_matrices = [ '{}/{}'.format(permuted_matrix_dir, f) for f in files if f.lower().endswith('.json') ]
         permuted_directory_files.append( permuted_matrices[:num_permutations] )
     assert( len(files) == num_permutations for files in permuted_directory_files )
 
-    return zip(*permuted_directory_files)
+    return list(zip(*permuted_directory_files))
 
 # Load a list of weights files, merging them at the patient and gene level.
 # Note that if a (gene, patient) pair is present in more than one file, it will
@@ -100,6 +126,15 @@ def run( args ):
     # Provide additional checks on arguments
     assert( len(args.mutation_files) == len(args.weights_files) )
 
+    # The weights are only estimated for genes mutated in at least the minimum
+    # frequency they were computed with, so it cannot be larger than ours
+    for weights_file in args.weights_files:
+        min_frequency = weights_min_frequency(weights_file)
+        if min_frequency is not None and min_frequency > args.min_frequency:
+            sys.stderr.write('Weights file {} only has weights for genes mutated in >={} patients, so -f/--min_frequency '\
+                             'must be at least {}.\n'.format(weights_file, min_frequency, min_frequency))
+            sys.exit(1)
+
     # Load the mutation data
     if args.verbose > 0:
         print(('-' * 30), 'Input Mutation Data', ('-' * 29))
@@ -144,8 +179,25 @@ def run( args ):
     if args.verbose > 0: 
         print(('-' * 31), 'Enumerating Sets', ('-' * 31))
     k = args.gene_set_size
-    # Create a list of sets to test
-    sets = list( frozenset(t) for t in combinations(genes, k) )
+    # Create a matrix of the sets to test (in the given shard), as indices
+    # into the genes, only keeping the sets connected in the network if given
+    genes = sorted(genes)
+    num_omitted = 0
+    if args.only_cooccurring:
+        if args.statistic == EXCLUSIVITY or args.shard or args.network_file:
+            raise NotImplementedError('--only_cooccurring is only implemented for co-occurrence statistics, '\
+                                      'without sharding or a network.')
+        sets = cooccurring_set_matrix(genes, geneToCases, k, nameToStatistic[args.statistic])
+        num_omitted = comb(len(genes), k, exact=True) - len(sets)
+    elif args.network_file:
+        neighbors = network_neighbors(genes, load_network(args.network_file))
+        ranks = shard_ranks(num_connected_subgraphs(neighbors, k), parse_shard(args.shard)) if args.shard else ()
+        sets = connected_set_matrix(neighbors, k, *ranks)
+    elif args.shard:
+        ranks = shard_ranks(comb(len(genes), k, exact=True), parse_shard(args.shard))
+        sets = combination_matrix(len(genes), k, *ranks)
+    else:
+        sets = np.array(list(combinations(range(len(genes)), k)), dtype=np.int32).reshape(-1, k)
     num_sets = len(sets)
 
     if args.verbose  > 0: 
@@ -154,9 +206,22 @@ def run( args ):
     method = nameToMethod['Saddlepoint']
     test = nameToTest['WRE']
     statistic = nameToStatistic[args.statistic]
-    setToPval, setToRuntime, setToFDR, setToObs = general_test_sets(sets, geneToCases, num_patients, method, test, statistic, geneToP, args.num_cores,
-                                                            verbose=args.verbose, report_invalids=args.report_invalids)
-    output_enumeration_table( args, k, setToPval, setToRuntime, setToFDR, setToObs, args.fdr_threshold )
+    if args.pvalue_cache:
+        cache = pvalue_cache(args.pvalue_cache, geneToCases, num_patients, test, method, geneToP, statistic)
+    else:
+        cache = None
+    checkpoint_params = dict()
+    if args.checkpoint_dir:
+        init_checkpoint_dir(args.checkpoint_dir, args.resume)
+        checkpoint_params['checkpoint_dir'] = args.checkpoint_dir
+        if args.checkpoint_size:
+            checkpoint_params['checkpoint_size'] = args.checkpoint_size
+    results = general_test_sets(genes, sets, geneToCases, num_patients, method, test, statistic, geneToP, args.num_cores,
+                                verbose=args.verbose, report_invalids=args.report_invalids, cache=cache,
+                                num_omitted=num_omitted, **checkpoint_params)
+    # The FDRs of a shard are only computed over its sets, so we output every
+    # set and leave the FDR threshold to merge_results.py
+    output_enumeration_table( args, k, results, 1 if args.shard else args.fdr_threshold )
 
 if __name__ == '__main__': 
     run( get_parser().parse_args(sys.argv[1:]) )
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# Load required modules
+import sys, os, argparse, heapq, tempfile, shutil, numpy as np
+from itertools import groupby
+
+# Load WExT, ensuring that it is in the path (unless this script was moved)
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from wext import *
+
+# Argument parser
+def get_parser():
+    parser = argparse.ArgumentParser(description='Merge the outputs of sharded enumeration runs (find_exclusive_sets.py '\
+                                                 'or find_sets.py with --shard), recomputing the FDRs over all sets.')
+    parser.add_argument('-rf', '--results_files', type=str, required=True, nargs='*',
+                        help='Shard outputs, either all tables (.tsv) or all results archives (.npz).')
+    parser.add_argument('-o', '--output_file', type=str, required=True)
+    parser.add_argument('-fdr', '--fdr_threshold', type=float, default=1, required=False)
+    parser.add_argument('-td', '--tmp_dir', type=str, required=False, default=None)
+    parser.add_argument('-v', '--verbose', type=int, required=False, default=1, choices=list(range(5)))
+    return parser
+
+# Iterate over the (P-value, shard, line, row) tuples of a table, which are
+# sorted ascending by P-value. The shard and line numbers break ties, so the
+# rows themselves are never compared.
+def table_rows( results_file, shard ):
+    with open(results_file, 'r') as IN:
+        for i, l in enumerate(IN):
+            if not l.startswith('#'):
+                row = l.rstrip('\n').split('\t')
+                yield float(row[1]), shard, i, row
+
+# Merge the rows of the tables ascending by P-value, reading one row of each
+# table at a time
+def merged_rows( results_files ):
+    return heapq.merge(*[ table_rows(f, shard) for shard, f in enumerate(results_files) ])
+
+def run( args ):
+    is_archive = is_results_archive(args.results_files[0])
+    if any( is_results_archive(f) != is_archive for f in args.results_files ):
+        raise ValueError('Shard outputs must all be tables or all be results archives.')
+    if is_archive:
+        header = load_results_header(args.results_files[0])
+        if any( load_results_header(f)['genes'] != header['genes'] for f in args.results_files ):
+            raise ValueError('Shard outputs must be over the same genes.')
+
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        num_output = 0
+        # Results archives do not need to be sorted: compute the FDRs over all
+        # the sets of the shards chunk by chunk, and copy the chunks of each
+        # shard with their new FDRs, keeping the sets passing the FDR threshold
+        if is_archive:
+            chunks = correct_archive_chunks(args.results_files, tmp_dir, method='BY')
+            if args.verbose > 0:
+                num_sets = sum( len(np.load(pvalue_file, mmap_mode='r')) for _, _, pvalue_file, _ in chunks )
+                print('* Merging {} sets from {} shards...'.format(num_sets, len(args.results_files)))
+
+            create_results_archive(args.output_file, header['genes'], dict(header['params'], shard=None,
+                                                                           results_files=args.results_files))
+            for results_file, shard_chunks in groupby(chunks, key=lambda c: c[0]):
+                with np.load(results_file) as data:
+                    for _, name, _, fdr_file in shard_chunks:
+                        fdr = np.load(fdr_file)
+                        keep = fdr <= args.fdr_threshold
+                        if not np.any(keep): continue
+                        chunk = dict( (column, data['{}/{}'.format(name, column)][keep]) for column in RESULT_COLUMNS if column != 'fdr' )
+                        chunk.update(fdr=fdr[keep], genes=header['genes'])
+                        append_results_archive(args.output_file, chunk)
+                        num_output += int(np.sum(keep))
+
+        # Tables are merged twice ascending by P-value: first to write the
+        # merged P-values to a temporary file and compute the FDRs over all
+        # the sets, then to output the sets passing the FDR threshold with
+        # their new FDRs
+        else:
+            pvalue_file = os.path.join(tmp_dir, 'pvalues.bin')
+            num_sets = 0
+            with open(pvalue_file, 'wb') as OUT:
+                buf = []
+                for row in merged_rows(args.results_files):
+                    buf.append(row[0])
+                    if len(buf) == 10**6:
+                        OUT.write(np.array(buf, dtype=np.float64).tobytes())
+                        num_sets, buf = num_sets + len(buf), []
+                OUT.write(np.array(buf, dtype=np.float64).tobytes())
+                num_sets += len(buf)
+            if args.verbose > 0:
+                print('* Merging {} sets from {} shards...'.format(num_sets, len(args.results_files)))
+
+            p_values = np.memmap(pvalue_file, dtype=np.float64, mode='r', shape=(num_sets,)) if num_sets else np.zeros(0)
+            q_values = np.memmap(os.path.join(tmp_dir, 'qvalues.bin'), dtype=np.float64, mode='w+', shape=(num_sets,)) if num_sets else np.zeros(0)
+            sorted_multiple_hypothesis_correction(p_values, q_values, method='BY')
+
+            with open(args.results_files[0], 'r') as IN:
+                table_header = IN.readline().rstrip('\n')
+            with open(args.output_file, 'w') as OUT:
+                OUT.write(table_header)
+                for (_, _, _, row), fdr in zip(merged_rows(args.results_files), q_values):
+                    if fdr <= args.fdr_threshold:
+                        row[2] = str(float(fdr))
+                        OUT.write('\n' + '\t'.join(row))
+                        num_output += 1
+            del p_values, q_values
+
+        if args.verbose > 0:
+            print('- Output {} sets with FDR <= {}'.format(num_output, args.fdr_threshold))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    run( get_parser().parse_args(sys.argv[1:]) )
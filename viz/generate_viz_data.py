@@ -27,19 +27,24 @@ def run( args ):
     setToRuntime, setToObs = defaultdict(dict), defaultdict(dict)
     sets, methods = set(), set()
     for results_file in args.results_files:
-        with open(results_file, 'r') as IN:
-            obj = json.load(IN)
-            params = obj['params']
-            min_frequency = params['min_frequency']
-            is_rce = nameToTest[params['test']] == RCE
-            method_paren = '' if is_rce else ' ({})'.format(params['method'])
-            run_name = '{}{}'.format(params['test'], method_paren)
-            methods.add( run_name )
-            setToPval[run_name].update( list(obj['setToPval'].items()) )
-            setToRuntime[run_name].update( list(obj['setToRuntime'].items()) )
-            setToFDR[run_name].update( list(obj['setToFDR'].items()) )
-            setToObs[run_name].update(list(obj['setToObs'].items()) )
-            sets |= set(obj['setToPval'].keys())
+        # Results archives are converted to the dictionaries of the JSON files
+        if is_results_archive(results_file):
+            obj = convert_results_for_json(load_results_archive(results_file))
+            obj['params'] = load_results_header(results_file)['params']
+        else:
+            with open(results_file, 'r') as IN:
+                obj = json.load(IN)
+        params = obj['params']
+        min_frequency = params['min_frequency']
+        is_rce = nameToTest[params['test']] == RCE
+        method_paren = '' if is_rce else ' ({})'.format(params['method'])
+        run_name = '{}{}'.format(params['test'], method_paren)
+        methods.add( run_name )
+        setToPval[run_name].update( list(obj['setToPval'].items()) )
+        setToRuntime[run_name].update( list(obj['setToRuntime'].items()) )
+        setToFDR[run_name].update( list(obj['setToFDR'].items()) )
+        setToObs[run_name].update(list(obj['setToObs'].items()) )
+        sets |= set(obj['setToPval'].keys())
 
     # Load the mutation data
     mutation_data = load_mutation_data( args.mutation_file, min_frequency )
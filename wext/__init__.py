@@ -3,8 +3,17 @@
 # Import modules
 from .constants import *
 from .statistics import *
+from .results import *
+from .results_archive import *
+from .checkpoint import *
+from .gene_classes import *
+from .network import *
+from .cooccurrence import *
 from .i_o import *
 from .enumerate_sets import *
+from .permutation_archive import *
+from .weights import *
+from .cache import *
 from .mcmc import mcmc
 from .exact import exact_test
 import cpoibin
@@ -12,4 +21,4 @@ import wext_exact_test
 from .saddlepoint import saddlepoint
 import comet_exact_tests
 from .exclusivity_tests import re_test, wre_test
-from bipartite_edge_swap_module import bipartite_edge_swap
\ No newline at end of file
+from bipartite_edge_swap_module import bipartite_edge_swap, bipartite_edge_swap_sparse, bipartite_edge_swap_chain, bipartite_edge_swap_chain_counts, bipartite_edge_swap_counts, bipartite_edge_swap_batch
\ No newline at end of file
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Load required modules
+import os, sqlite3, hashlib, numpy as np
+
+# Persistent cache of P-values shared across runs, stored in an SQLite file.
+# Each gene set is keyed by a hash of the test, method, statistic, number of
+# patients and, for each gene in the set (in sorted order), the gene, its
+# mutated patients and its weights. Sets therefore keep their key across runs
+# with different gene set sizes, minimum frequencies or search strategies, but
+# any change to the data behind a set gives it a new key.
+#
+# Only the parent process writes to the cache; worker processes read from it
+# with their own connections.
+def pvalue_cache( cache_file, geneToCases, num_patients, test, method, P=None, statistic=None ):
+    namespace = hashlib.sha1('{}\t{}\t{}\t{}'.format(test, method, statistic, num_patients).encode('utf-8')).digest()
+    geneToDigest = dict()
+    for g, cases in geneToCases.items():
+        digest = hashlib.sha1('{}\t{}'.format(g, '\t'.join(sorted(cases))).encode('utf-8'))
+        if P is not None and g in P:
+            digest.update(np.ascontiguousarray(P[g], dtype=np.float64).tobytes())
+        geneToDigest[g] = digest.digest()
+
+    cache = dict(cache_file=cache_file, namespace=namespace, geneToDigest=geneToDigest)
+    conn = _connection(cache)
+    conn.execute('CREATE TABLE IF NOT EXISTS pvalues (key BLOB PRIMARY KEY, pval REAL)')
+    conn.commit()
+    return cache
+
+# Each process opens its own connection to the cache
+_connections = dict()
+def _connection( cache ):
+    key = (cache['cache_file'], os.getpid())
+    if key not in _connections:
+        _connections[key] = sqlite3.connect(cache['cache_file'], timeout=60)
+    return _connections[key]
+
+def _set_key( cache, M ):
+    digest = hashlib.sha1(cache['namespace'])
+    for g in sorted(M):
+        digest.update(cache['geneToDigest'][g])
+    return digest.digest()
+
+# Look up the cached P-values of the given sets, returning those found
+def load_cached_pvalues( cache, sets, chunk_size=500 ):
+    keyToSet = dict( (_set_key(cache, M), M) for M in sets )
+    keys = list(keyToSet.keys())
+    conn = _connection(cache)
+    setToPval = dict()
+    for i in range(0, len(keys), chunk_size):
+        chunk = keys[i:i+chunk_size]
+        query = 'SELECT key, pval FROM pvalues WHERE key IN ({})'.format(','.join('?' * len(chunk)))
+        for key, pval in conn.execute(query, chunk):
+            setToPval[keyToSet[bytes(key)]] = pval
+    return setToPval
+
+# Add P-values to the cache. NaNs are not stored (SQLite would store NULL).
+def store_pvalues( cache, setToPval ):
+    conn = _connection(cache)
+    conn.executemany('INSERT OR IGNORE INTO pvalues (key, pval) VALUES (?, ?)',
+                     ( (_set_key(cache, M), pval) for M, pval in setToPval.items() if pval == pval ))
+    conn.commit()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+# Load required modules
+import os, json, hashlib, numpy as np
+from .results import *
+
+# Long runs save their progress to checkpoint files, so they can be resumed
+# after being killed. Each checkpoint is a .npz file that is written to a
+# temporary file and then renamed, so it is either complete or absent. The
+# checkpoint stores the parameters of the run that wrote it, and resuming
+# with different parameters is an error.
+def init_checkpoint_dir( checkpoint_dir, resume=False ):
+    if os.path.isdir(checkpoint_dir) and os.listdir(checkpoint_dir) and not resume:
+        raise ValueError('Checkpoint directory {} is not empty (use --resume to continue from it)'.format(checkpoint_dir))
+    if not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+# Digest of a sequence of strings or arrays, to identify the inputs of a run
+def checkpoint_digest( items ):
+    digest = hashlib.sha1()
+    for item in items:
+        digest.update(np.ascontiguousarray(item).tobytes() if isinstance(item, np.ndarray) else str(item).encode('utf-8'))
+        digest.update(b'\t')
+    return digest.hexdigest()
+
+# Digest of the mutated patients (and weights) of the given genes and the
+# number of patients, so that resuming with different data is an error even
+# when the genes have the same names
+def mutation_data_digest( genes, geneToCases, num_patients, P=None ):
+    items = [ num_patients ] + [ '{}\t{}'.format(g, '\t'.join(sorted(geneToCases[g]))) for g in genes ]
+    if P is not None:
+        items += [ np.ascontiguousarray(P[g], dtype=np.float64) for g in genes ]
+    return checkpoint_digest(items)
+
+def save_checkpoint( checkpoint_file, params, **arrays ):
+    tmp_file = checkpoint_file + '.tmp'
+    with open(tmp_file, 'wb') as OUT:
+        np.savez(OUT, params=np.array(json.dumps(params, sort_keys=True)), **arrays)
+        OUT.flush()
+        os.fsync(OUT.fileno())
+    # os.replace needs Python 3.3, and on Windows os.rename does not replace
+    # an existing file, so we remove it first. A run killed in between
+    # leaves no checkpoint, and the work is redone.
+    try:
+        os.rename(tmp_file, checkpoint_file)
+    except OSError:
+        if not os.path.isfile(checkpoint_file):
+            raise
+        os.remove(checkpoint_file)
+        os.rename(tmp_file, checkpoint_file)
+
+# Load the arrays of a checkpoint, or None if there is no checkpoint
+def load_checkpoint( checkpoint_file, params ):
+    if not os.path.isfile(checkpoint_file):
+        return None
+    with np.load(checkpoint_file) as data:
+        if data['params'].item() != json.dumps(params, sort_keys=True):
+            raise ValueError('Checkpoint {} was saved by a run with different parameters'.format(checkpoint_file))
+        return dict( (name, data[name]) for name in data.files if name != 'params' )
+
+def save_results_checkpoint( checkpoint_file, params, results ):
+    save_checkpoint(checkpoint_file, params, **dict( (column, results[column]) for column in RESULT_COLUMNS ))
+
+def load_results_checkpoint( checkpoint_file, params, genes ):
+    checkpoint = load_checkpoint(checkpoint_file, params)
+    if checkpoint is not None:
+        checkpoint['genes'] = genes
+    return checkpoint
@@ -3,6 +3,14 @@
 # P-values are called invalid if P > 1+PTOL or P < -PTOL
 PTOL = 10**-3
 
+# Relative tolerance of the P-value bounds used to prune the enumeration, for
+# the rounding error of the computed P-values
+PVALUE_BOUND_RTOL = 10**-6
+
+# Default number of gene sets and of permuted matrices tested between checkpoints
+CHECKPOINT_NUM_SETS         = 10**5
+CHECKPOINT_NUM_PERMUTATIONS = 100
+
 # Set sizes implemented
 WRE_EXACT_SET_SIZES_IMPLEMENTED = set([2, 3])
 
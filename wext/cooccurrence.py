@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Load required modules
+import numpy as np
+from itertools import combinations
+from .constants import *
+
+# With a co-occurrence statistic, a set whose genes are never mutated together
+# in the required way has t=0 and P-value 1. These functions generate only the
+# other sets, from an inverted index of the genes mutated in each patient, so
+# sets without co-occurring patients are never materialized. Each set is
+# generated exactly once, in a fixed order, as a sorted tuple of indices into
+# the genes.
+
+# Index of the genes mutated in each patient (as indices into the genes), and
+# of the patients mutated in each gene (as indices into the patients)
+def patient_gene_index( genes, geneToCases ):
+    patients = sorted(set( p for g in genes for p in geneToCases[g] ))
+    patientToIndex = dict( (p, j) for j, p in enumerate(patients) )
+    geneToPatients = [ set( patientToIndex[p] for p in geneToCases[g] ) for g in genes ]
+    patientToGenes = [ [] for _ in patients ]
+    for i, cases in enumerate(geneToPatients):
+        for j in cases:
+            patientToGenes[j].append(i)
+    return patientToGenes, geneToPatients
+
+# Sets with at least one patient with two or more of their genes mutated, i.e.
+# that contain a pair of genes mutated in the same patient. Each set is
+# generated from its first such pair (a, b), by adding genes that do not form
+# a co-occurring pair that comes before (a, b).
+def any_cooccurring_sets( patientToGenes, num_genes, k ):
+    neighbors = [ set() for _ in range(num_genes) ]
+    for mutated_genes in patientToGenes:
+        for a, b in combinations(mutated_genes, 2):
+            neighbors[a].add(b)
+            neighbors[b].add(a)
+
+    def extend( M, start, first_pair ):
+        if len(M) == k:
+            yield tuple(sorted(M))
+            return
+        for c in range(start, num_genes):
+            if c in first_pair: continue
+            if any( x in neighbors[c] and (min(c, x), max(c, x)) < first_pair for x in M ): continue
+            for N in extend(M + [c], c+1, first_pair):
+                yield N
+
+    for a in range(num_genes):
+        for b in sorted( b for b in neighbors[a] if b > a ):
+            for M in extend([a, b], 0, (a, b)):
+                yield M
+
+# Sets with at least one patient with all of their genes mutated, i.e. the
+# k-subsets of the genes mutated in each patient. Each set is generated from
+# the first patient with all of its genes mutated.
+def all_cooccurring_sets( patientToGenes, geneToPatients, k ):
+    for j, mutated_genes in enumerate(patientToGenes):
+        for M in combinations(mutated_genes, k):
+            if min(set.intersection(*[ geneToPatients[g] for g in M ])) == j:
+                yield M
+
+# Matrix of the k-subsets of the genes that can have t > 0 with the given
+# co-occurrence statistic
+def cooccurring_set_matrix( genes, geneToCases, k, statistic ):
+    patientToGenes, geneToPatients = patient_gene_index(genes, geneToCases)
+    if statistic == ANY_CO_OCCURRENCE:
+        sets = any_cooccurring_sets(patientToGenes, len(genes), k)
+    elif statistic == ALL_CO_OCCURRENCE:
+        sets = all_cooccurring_sets(patientToGenes, geneToPatients, k)
+    else:
+        raise NotImplementedError('Only co-occurrence statistics have sets with t=0 to skip.')
+    return np.array(list(sets), dtype=np.int32).reshape(-1, k)
@@ -1,15 +1,23 @@
 #!/usr/bin/env python
 
 # Load required modules
-import sys, multiprocessing as mp, json
+import sys, os, multiprocessing as mp, json, heapq, numpy as np
 from time import time
 from collections import defaultdict, Counter
-from math import ceil, isnan
+from itertools import combinations, islice
+from math import ceil, isnan, exp, lgamma
+from scipy.special import comb
 
 # Load local modules
 from .exclusivity_tests import wre_test, re_test, general_wre_test
 from .constants import *
-from .statistics import multiple_hypothesis_correction
+from .statistics import multiple_hypothesis_correction, bounded_multiple_hypothesis_correction, log_bins, NUM_LOG_BINS
+from .permutation_archive import load_permutation_archive, packed_exclusivity
+from .cache import load_cached_pvalues, store_pvalues
+from .results import *
+from .results_archive import append_results_archive, correct_results_archive
+from .checkpoint import *
+from .gene_classes import expand_results
 
 ################################################################################
 # Permutational test
@@ -22,6 +30,10 @@ def T(M, geneToCases):
 # Compute the permutational
 def permutational_dist_wrapper( args ): return permutational_dist( *args )
 def permutational_dist( sets, permuted_files ):
+    # Permuted matrices stored in archives are referenced by (archive, index)
+    if len(permuted_files) > 0 and isinstance(permuted_files[0][0], tuple):
+        return archive_permutational_dist( sets, permuted_files )
+
     setToDist, setToTime = defaultdict(list), defaultdict(int)
     for pf_group in permuted_files:
         # Load the file, keeping track of how long it takes
@@ -43,7 +55,43 @@ def permutational_dist( sets, permuted_files ):
 
     return setToDist, setToTime
 
-def rce_permutation_test(sets, geneToCases, num_patients, permuted_files, num_cores=1, verbose=0):
+# Compute the permutational distribution from permutation archives, reading
+# the bit-packed matrices directly in chunks of permutations. As when merging
+# JSON files, we assume that the archives have disjoint sets of patients, so
+# the number of exclusive mutations is the sum over the archives.
+def archive_permutational_dist( sets, permuted_files, chunk_size=1000 ):
+    setToDist, setToTime = defaultdict(list), defaultdict(int)
+    num_permutations = len(permuted_files)
+    setToT = dict( (M, np.zeros(num_permutations, dtype=np.int64)) for M in sets )
+    for t in range(len(permuted_files[0])):
+        archive_file = permuted_files[0][t][0]
+        indices = np.array([ pf_group[t][1] for pf_group in permuted_files ])
+        header, records = load_permutation_archive( archive_file )
+        geneToRow = dict( (g, i) for i, g in enumerate(header['genes']) )
+        setToRows = dict( (M, [ geneToRow[g] for g in M if g in geneToRow ]) for M in sets )
+
+        for start in range(0, num_permutations, chunk_size):
+            # Load the chunk, keeping track of how long it takes
+            reading_start = time()
+            packed = np.asarray(records['matrix'][indices[start:start+chunk_size]])
+            reading_time = time() - reading_start
+
+            # Iterate through the sets, keeping track of how long
+            # it takes to compute the test statistic
+            for M, rows in setToRows.items():
+                start_M = time()
+                setToT[M][start:start+chunk_size] += packed_exclusivity( packed, rows )
+                setToTime[M] += reading_time + (time() - start_M)
+
+    for M, dist in setToT.items():
+        setToDist[M] = dist.tolist()
+
+    return setToDist, setToTime
+
+def rce_permutation_test(genes, sets, geneToCases, num_patients, permuted_files, num_cores=1, verbose=0,
+                         checkpoint_dir=None, checkpoint_size=CHECKPOINT_NUM_PERMUTATIONS):
+    sets = [ frozenset( genes[g] for g in row ) for row in sets ]
+
     # Set up the multi-core process
     num_cores = num_cores if num_cores != -1 else mp.cpu_count()
     if num_cores != 1:
@@ -54,39 +102,57 @@ def rce_permutation_test(sets, geneToCases, num_patients, permuted_files, num_co
 
     # Filter the sets based on the observed values
     k = len(next(iter(sets)))
-    setToObs = dict( (M, observed_values(M, num_patients, geneToCases)) for M in sets )
-    sets = set( M for M, (X, T, Z, tbl) in setToObs.items() if testable_set(k, T, Z, tbl) )
-
-    # Compute the distribution of exclusivity for each pair across the permuted files
-    np    = float(len(permuted_files))
-    args  = [ (sets, permuted_files[i::num_cores]) for i in range(num_cores) ]
-    empirical_distributions = map_fn(permutational_dist_wrapper, args)
+    setToObs = dict( (M, observed_values(sorted(M), num_patients, geneToCases)) for M in sets )
+    sets = [ M for M in sets if testable_set(k, *setToObs[M][1:]) ]
+
+    # Count the permutations with at least the observed exclusivity of each
+    # set, in blocks of permuted files. If a checkpoint directory is given, we
+    # save the counts after each block, and start from the saved counts.
+    num_permutations = float(len(permuted_files))
+    counts, runtimes, num_permuted = np.zeros(len(sets)), np.zeros(len(sets)), 0
+    if checkpoint_dir:
+        block_size = checkpoint_size
+        checkpoint_file = os.path.join(checkpoint_dir, 'rce.npz')
+        params = dict(genes=checkpoint_digest(genes), sets=checkpoint_digest( sorted(M) for M in sets ),
+                      data=mutation_data_digest(genes, geneToCases, num_patients),
+                      permuted_files=checkpoint_digest(permuted_files))
+        checkpoint = load_checkpoint(checkpoint_file, params)
+        if checkpoint is not None:
+            counts, runtimes, num_permuted = checkpoint['counts'], checkpoint['runtimes'], int(checkpoint['num_permuted'])
+    else:
+        block_size = max(len(permuted_files), 1)
+
+    for start in range(num_permuted, len(permuted_files), block_size):
+        # Compute the distribution of exclusivity for each set across the permuted files
+        block = permuted_files[start:start+block_size]
+        args  = [ (sets, block[i::num_cores]) for i in range(num_cores) ]
+        setToTime = dict()
+        for dist, times in map_fn(permutational_dist_wrapper, args):
+            setToTime.update(list(times.items()))
+            for i, M in enumerate(sets):
+                observed_T = setToObs[M][1]
+                counts[i] += sum( 1. for d in dist.get(M, []) if d >= observed_T )
+        runtimes += [ setToTime.get(M, 0) for M in sets ]
+
+        if checkpoint_dir:
+            save_checkpoint(checkpoint_file, params, counts=counts, runtimes=runtimes,
+                            num_permuted=start + len(block))
 
     if num_cores != 1:
         pool.close()
         pool.join()
 
-    # Merge the different distributions
-    setToDist, setToTime = defaultdict(list), dict()
-    for dist, times in empirical_distributions:
-        setToTime.update(list(times.items()))
-        for k, v in dist.tems():
-            setToDist[k].extend(v)
-
-    # Compute the observed values and then the P-values
+    # Compute the P-values
     setToObs = dict( (M, setToObs[M]) for M in sets )
-    setToPval = dict()
-    for M, (X, T, Z, tbl) in setToObs.items():
-        # Compute the P-value.
-        count = sum( 1. for d in setToDist[M] if d >= T )
-        setToPval[M] = count / np
+    setToPval = dict( (M, count / num_permutations) for M, count in zip(sets, counts) )
+    setToTime = dict( zip(sets, runtimes) )
 
     # Compute FDRs
     tested_sets = setToPval.keys()
     pvals = [ setToPval[M] for M in tested_sets ]
     setToFDR = dict(list(zip(tested_sets, multiple_hypothesis_correction(pvals, method="BY"))))
 
-    return setToPval, setToTime, setToFDR, setToObs
+    return results_from_dicts(genes, setToPval, setToTime, setToFDR, setToObs)
 
 ################################################################################
 # Weighted and unweighted tests
@@ -120,41 +186,120 @@ def observed_values( M, N, geneToCases ):
 
     return X, T, Z, tbl
 
-# Test the given sets with the given method and test
+# Test the given sets (rows of gene indices into the sorted list of genes)
+# with the given method and test
 def test_set_group_wrapper(args): return test_set_group(*args)
-def test_set_group( sets, geneToCases, num_patients, method, test, P=None, verbose=0 ):
+def test_set_group( genes, sets, geneToCases, num_patients, method, test, P=None, verbose=0, cache=None, batch_size=10000 ):
     # Construct the arguments to test each set
-    setToPval, setToTime, setToObs = dict(), dict(), dict()
-    num_sets = len(sets)
-    k = len(next(iter(sets)))
-    for i, M in enumerate(sets):
-        # Simple progress bar
-        if verbose > 1:
-            sys.stdout.write('\r* Testing {}/{} triples...'.format(i+1, num_sets))
-            sys.stdout.flush()
+    columns = empty_result_columns()
+    num_sets, k = np.shape(sets)
+    for batch_start in range(0, num_sets, batch_size):
+        batch = [ tuple( genes[g] for g in row ) for row in sets[batch_start:batch_start+batch_size] ]
+        cachedPvals = load_cached_pvalues(cache, batch) if cache else dict()
+        for i, sorted_M in enumerate(batch):
+            # Simple progress bar
+            if verbose > 1:
+                sys.stdout.write('\r* Testing {}/{} triples...'.format(batch_start+i+1, num_sets))
+                sys.stdout.flush()
+
+            # Do some simple mutation processing
+            X, T, Z, tbl = obs = observed_values(sorted_M, num_patients, geneToCases )
+
+            # Ignore the opposite tail, where we have more co-occurrences than exclusivity
+            if not testable_set(k, T, Z, tbl): continue
+
+            # Use the P-value from the cache if we have it
+            start = time()
+            if sorted_M in cachedPvals:
+                pval = cachedPvals[sorted_M]
+
+            # Compute the saddlepoint approximations
+            elif test == WRE:
+                pval = wre_test( T, X, [ P[g] for g in sorted_M ], method )
+            elif test == RE:
+                pval = re_test( T, X, tbl, method )
+            else:
+                raise NotImplementedError("Test {} not implemented".format(testToName[test]))
+
+            append_result(columns, sets[batch_start+i], pval, time() - start if sorted_M not in cachedPvals else 0., obs)
+
+    return results_from_columns(genes, k, columns)
+
+# Test the sets in blocks of block_size, yielding the results of each block.
+# If a checkpoint directory is given, the results of each block are saved to
+# it, and the blocks saved by a previous run are loaded instead of tested again.
+def tested_blocks( test_block, genes, sets, block_size, params=None, checkpoint_dir=None ):
+    for start in range(0, max(len(sets), 1), block_size):
+        block = sets[start:start+block_size]
+        if not checkpoint_dir:
+            yield concatenate_results(test_block(block))
+            continue
+        block_params = dict(params, start=start, sets=checkpoint_digest([block]))
+        checkpoint_file = os.path.join(checkpoint_dir, 'sets-{}.npz'.format(start))
+        block_results = load_results_checkpoint(checkpoint_file, block_params, genes)
+        if block_results is None:
+            block_results = concatenate_results(test_block(block))
+            save_results_checkpoint(checkpoint_file, block_params, block_results)
+        yield block_results
+
+# Add the P-values of the results to the cache, and remove the sets with
+# invalid P-values, reporting them if requested
+def valid_test_results( results, verbose=0, report_invalids=False, cache=None ):
+    # Add the new P-values to the cache
+    if cache:
+        store_pvalues(cache, dict( (tuple(result_genes(results, i)), pval) for i, pval in enumerate(results['pval']) ))
 
-        # Do some simple mutation processing
-        sorted_M = sorted(M)
-        X, T, Z, tbl = setToObs[M] = observed_values(sorted_M, num_patients, geneToCases )
+    # Make sure all P-values are numbers
+    pval = results['pval']
+    invalid = np.isnan(pval) | (-PTOL > pval) | (pval > 1+PTOL)
 
-        # Ignore the opposite tail, where we have more co-occurrences than exclusivity
-        if not testable_set(k, T, Z, tbl): continue
+    # Report invalid sets
+    if verbose > 0 and report_invalids:
+        sys.stderr.write('- Found {} sets with invalid P-values\n'.format(int(np.sum(invalid))))
+        invalid_rows = []
+        for i in np.flatnonzero(invalid):
+            X, T, Z, tbl = result_observed(results, i)
+            invalid_rows.append([ ','.join(result_genes(results, i)), T, Z, tbl, pval[i] ])
+        sys.stderr.write( '\t' + '\n\t '.join([ '\t'.join(map(str, row)) for row in invalid_rows ]) + '\n' )
 
-        # Compute the saddlepoint approximations
-        start = time()
-        if test == WRE:
-            setToPval[M] = wre_test( T, X, [ P[g] for g in sorted_M ], method )
-        elif test == RE:
-            setToPval[M] = re_test( T, X, tbl, method )
-        else:
-            raise NotImplementedError("Test {} not implemented".format(testToName[test]))
+    return select_results(results, ~invalid)
+
+def report_test_results( num_output, num_invalid, num_ignored, num_omitted=0 ):
+    print('- Output {} sets'.format(num_output))
+    print('\tRemoved {} sets with NaN or invalid P-values'.format(num_invalid))
+    print('\tIgnored {} sets with Z >= T or a gene with no exclusive mutations'.format(num_ignored))
+    if num_omitted:
+        print('\tOmitted {} sets with P-value 1'.format(num_omitted))
+
+# Merge the results of each worker, removing sets with invalid P-values and
+# computing the FDRs. The num_omitted sets that were not tested because they
+# have P-value 1 are counted as such in the FDRs.
+def merge_test_results( results_list, num_sets, verbose=0, report_invalids=False, cache=None, clip_pvals=False,
+                        num_omitted=0 ):
+    results = concatenate_results(results_list)
+    tested_sets = num_results(results)
+    results = valid_test_results(results, verbose, report_invalids, cache)
+    if verbose > 0:
+        report_test_results(num_results(results), tested_sets - num_results(results), num_sets - tested_sets, num_omitted)
 
-        setToTime[M] = time() - start
+    # Compute the FDRs
+    pvals = np.clip(results['pval'], 0.0, 1.0) if clip_pvals else results['pval']
+    if num_omitted:
+        dropped_counts = np.zeros(NUM_LOG_BINS, dtype=np.int64)
+        dropped_counts[-1] = num_omitted
+        results['fdr'] = bounded_multiple_hypothesis_correction(np.clip(pvals, 0.0, 1.0), dropped_counts, method="BY")
+    else:
+        results['fdr'] = multiple_hypothesis_correction(pvals, method="BY")
 
-    return setToPval, setToTime, setToObs
+    return results
 
-def test_sets( sets, geneToCases, num_patients, method, test, P=None, num_cores=1, verbose=0,
-               report_invalids=False):
+# Test the sets and compute their FDRs. If a results archive is given, the
+# results are appended to it a block at a time instead of being returned, so
+# they are never all in memory, and the FDRs are added to the archive once
+# every block has been tested.
+def test_sets( genes, sets, geneToCases, num_patients, method, test, P=None, num_cores=1, verbose=0,
+               report_invalids=False, cache=None, checkpoint_dir=None, checkpoint_size=CHECKPOINT_NUM_SETS,
+               representativeToMembers=None, archive_file=None):
     # Set up the multiprocessing
     num_cores = num_cores if num_cores != -1 else mp.cpu_count()
     if num_cores != 1:
@@ -164,76 +309,215 @@ def test_sets( sets, geneToCases, num_patients, method, test, P=None, num_cores=
         map_fn = map
 
     # Split up the sets and run multiprocessing
-    args = [ (sets[i::num_cores], geneToCases, num_patients, method, test, P, verbose)
-             for i in range(num_cores) ]
-    results = map_fn(test_set_group_wrapper, args)
+    def test_block( block ):
+        args = [ (genes, block[i::num_cores], geneToCases, num_patients, method, test, P, verbose, cache)
+                 for i in range(num_cores) ]
+        return list(map_fn(test_set_group_wrapper, args))
+
+    if checkpoint_dir or archive_file:
+        params = dict(genes=checkpoint_digest(genes), data=mutation_data_digest(genes, geneToCases, num_patients, P),
+                      method=method, test=test)
+        blocks = tested_blocks(test_block, genes, sets, checkpoint_size, params, checkpoint_dir)
+    else:
+        blocks = test_block(sets)
+
+    # Test the sets of members whose genes are not in the order of their
+    # representatives (see expand_results), over all the genes of the classes.
+    # They are testable like the sets of their representatives.
+    def retest( member_sets ):
+        member_genes = sorted( g for members in representativeToMembers.values() for g in members )
+        args = [ (member_genes, member_sets[i::num_cores], geneToCases, num_patients, method, test, P, 0, cache)
+                 for i in range(num_cores) ]
+        pvals = np.empty(len(member_sets))
+        for i, r in enumerate(map_fn(test_set_group_wrapper, args)):
+            pvals[i::num_cores] = r['pval']
+        return pvals
+
+    # Expand the results over class representatives to all members of the
+    # classes (see gene_classes.py), and append the valid results of each
+    # block to the archive, sorted by P-value
+    results, num_tested, num_output = [], 0, 0
+    for block_results in blocks:
+        if representativeToMembers:
+            block_results = expand_results(block_results, representativeToMembers, retest)
+        if archive_file:
+            num_tested += num_results(block_results)
+            block_results = valid_test_results(block_results, verbose, report_invalids, cache)
+            num_output += num_results(block_results)
+            order = np.argsort(block_results['pval'], kind='stable')
+            append_results_archive(archive_file, select_results(block_results, order), with_fdr=False)
+        else:
+            results.append(block_results)
 
     if num_cores != 1:
         pool.close()
         pool.join()
 
-    # Combine the dictionaries
-    setToPval, setToTime, setToObs = dict(), dict(), dict()
-    for pval, time, obs in results:
-        setToPval.update(list(pval.items()))
-        setToTime.update(list(time.items()))
-        setToObs.update(list(obs.items()))
-
-    # Make sure all P-values are numbers
-    tested_sets = len(setToPval)
-    invalid_sets = set( M for M, pval in setToPval.items() if isnan(pval) or -PTOL > pval or pval > 1+PTOL )
-
-    # Report invalid sets
-    if verbose > 0 and report_invalids:
-        sys.stderr.write('- Found {} sets with invalid P-values\n'.format(len(invalid_sets)))
-        invalid_rows = []
-        for M in invalid_sets:
-            X, T, Z, tbl = setToObs[M]
-            invalid_rows.append([ ','.join(sorted(M)), T, Z, tbl, setToPval[M] ])
-        sys.stderr.write( '\t' + '\n\t '.join([ '\t'.join(map(str, row)) for row in invalid_rows ]) + '\n' )
-
-    setToPval = dict( (M, pval) for M, pval in setToPval.items() if not M in invalid_sets )
-    setToTime = dict( (M, runtime) for M, runtime in setToTime.items() if not M in invalid_sets )
-    setToObs = dict( (M, obs) for M, obs in setToObs.items() if not M in invalid_sets )
+    num_sets = len(sets)
+    if representativeToMembers:
+        num_sets = comb(sum( len(members) for members in representativeToMembers.values() ), np.shape(sets)[1], exact=True)
 
-    if verbose > 0:
-        print('- Output {} sets'.format(len(setToPval)))
-        print('\tRemoved {} sets with NaN or invalid P-values'.format(len(invalid_sets)))
-        print('\tIgnored {} sets with Z >= T or a gene with no exclusive mutations'.format(len(sets)-tested_sets))
+    if archive_file:
+        if verbose > 0:
+            report_test_results(num_output, num_tested - num_output, num_sets - num_tested)
+        correct_results_archive(archive_file, method='BY')
+        return None
 
-    # Compute the FDRs
-    tested_sets = list(setToPval.keys())
-    pvals = [ setToPval[M] for M in tested_sets ]
-    setToFDR = dict(list(zip(tested_sets, multiple_hypothesis_correction(pvals, method="BY"))))
+    return merge_test_results(results, num_sets, verbose, report_invalids, cache)
 
-    return setToPval, setToTime, setToFDR, setToObs
+################################################################################
+# Bounds for pruning the enumeration
+################################################################################
+# Smallest possible RE P-value of a set with mutation counts x. The RE P-value
+# is P(T >= t | x) with the mutations of each gene placed uniformly at random,
+# and T <= sum(x) with equality exactly when the mutations are disjoint, so
+# the P-value is at least the probability that they are disjoint. The bound
+# decreases as any count in x increases. It bounds the exact P-value, which
+# the saddlepoint approximation can fall below in the far tail.
+def re_pvalue_lower_bound( x, N ):
+    s = sum(x)
+    if s > N: return 0.
+    return exp( lgamma(N+1) - lgamma(N-s+1) + sum( lgamma(N-x_i+1) - lgamma(N+1) for x_i in x ) ) * (1-PVALUE_BOUND_RTOL)
+
+# Bitmask (as a Python integer) of the patients mutated in each gene
+def gene_masks( genes, geneToCases ):
+    patientToIndex = dict( (p, i) for i, p in enumerate(sorted(set( p for g in genes for p in geneToCases[g] ))) )
+    return [ sum( 1 << patientToIndex[p] for p in geneToCases[g] ) for g in genes ]
+
+# Iterate over the k-subsets of the genes (given by their masks) starting with
+# one of first_genes, as tuples of indices in lexicographic order, skipping
+# each gene prefix whose completions can all be skipped. Adding genes to a
+# prefix keeps its co-occurring patients (Z) co-occurring and its genes with
+# no exclusive mutations without any, and adds at most the added genes'
+# mutations to T. A prefix is skipped if:
+# 1) no completion is testable (a gene has no exclusive mutations, or T can
+#    not exceed Z); or
+# 2) pvalue_bound of the mutation counts of the prefix and the remaining genes
+#    with the most mutations (a lower bound for every completion) is above
+#    threshold().
+# The number of testable sets skipped by 2), which are found by walking the
+# completions of the prefix without testing them, is added to
+# summary['num_pruned'], so they are counted like the sets of a full
+# enumeration.
+def pruned_combinations( masks, k, first_genes, summary, pvalue_bound=None, threshold=None ):
+    n = len(masks)
+    x = [ bin(m).count('1') for m in masks ]
+    suffixTop = [[]] * n # the k largest counts of the genes after each gene
+    for i in range(n-2, -1, -1):
+        suffixTop[i] = sorted(suffixTop[i+1] + [x[i+1]], reverse=True)[:k]
+
+    def walk( prefix, covered, multi, bounded=True ):
+        r = k - len(prefix)
+        for i in (first_genes if not prefix else range(prefix[-1]+1, n)):
+            if i > n - r: break
+            i_multi = multi | (covered & masks[i])
+            i_covered = covered | masks[i]
+            Z = bin(i_multi).count('1')
+            T = bin(i_covered).count('1') - Z
+            top = suffixTop[i][:r-1]
+            if T + sum(top) <= Z or any( not masks[j] & ~i_multi for j in prefix + [i] ):
+                continue
+            if bounded and pvalue_bound is not None:
+                max_pval = threshold()
+                if max_pval is not None and pvalue_bound([ x[j] for j in prefix ] + [x[i]] + top) > max_pval:
+                    summary['num_pruned'] += 1 if r == 1 else sum( 1 for _ in walk(prefix + [i], i_covered, i_multi, False) )
+                    continue
+            if r == 1:
+                yield tuple(prefix + [i])
+            else:
+                for M in walk(prefix + [i], i_covered, i_multi, bounded):
+                    yield M
+
+    return walk([], 0, 0)
+
+# Test every k-subset of the given genes with the given method and test,
+# keeping only the top_k sets with the smallest P-values and/or those with
+# P-value at most pvalue_threshold. The worker with the given start tests
+# the sets whose first gene is start, start+step, start+2*step, ..., 
+# generating them as it goes, and only counts the P-values of the sets it
+# drops (in the log-scale bins of log_bins), so memory does not depend on the
+# number of sets. Sets that cannot be testable are never generated, and with
+# the exact RE test, neither are sets whose P-value bound shows they cannot be
+# kept (see pruned_combinations); the latter are counted as dropped with
+# P-value 1.
+def bounded_test_set_group_wrapper(args): return bounded_test_set_group(*args)
+def bounded_test_set_group( genes, k, start, step, geneToCases, num_patients, method, test, P=None, top_k=None,
+                            pvalue_threshold=None, verbose=0, cache=None, batch_size=10000 ):
+    heap, dropped_counts = [], np.zeros(NUM_LOG_BINS, dtype=np.int64)
+    first_genes = range(start, len(genes), step)
+    summary = dict(num_sets=sum( comb(len(genes)-i-1, k-1, exact=True) for i in first_genes ),
+                   num_tested=0, num_invalid=0, num_pruned=0)
+
+    # The largest P-value a set can have and still be kept
+    def threshold():
+        if top_k is not None and len(heap) >= top_k:
+            return -heap[0][0] if pvalue_threshold is None else min(-heap[0][0], pvalue_threshold)
+        return pvalue_threshold
+
+    pvalue_bound = (lambda x: re_pvalue_lower_bound(x, num_patients)) if test == RE and method == EXACT else None
+    combos = pruned_combinations(gene_masks(genes, geneToCases), k, first_genes, summary, pvalue_bound, threshold)
+
+    # The sets are generated lazily, so the threshold is checked when each set
+    # is generated. With top_k, we test them in batches of at most top_k sets
+    # (for the cache lookups), so the threshold is set as soon as the heap is
+    # full and then lags it by at most one batch.
+    if top_k is not None:
+        batch_size = max(min(batch_size, top_k), 1)
+    num_generated = 0
+    while True:
+        sets = list(islice(combos, batch_size))
+        if not sets: break
+        num_generated += len(sets)
+        batch = [ tuple( genes[g] for g in row ) for row in sets ]
+        cachedPvals = load_cached_pvalues(cache, batch) if cache else dict()
+        newPvals, dropped = dict(), []
+        for row, sorted_M in zip(sets, batch):
+            X, T, Z, tbl = obs = observed_values(sorted_M, num_patients, geneToCases )
+
+            # Ignore the opposite tail, where we have more co-occurrences than exclusivity
+            if not testable_set(k, T, Z, tbl): continue
+
+            start_time = time()
+            if sorted_M in cachedPvals:
+                pval = cachedPvals[sorted_M]
+            elif test == WRE:
+                pval = newPvals[sorted_M] = wre_test( T, X, [ P[g] for g in sorted_M ], method )
+            elif test == RE:
+                pval = newPvals[sorted_M] = re_test( T, X, tbl, method )
+            else:
+                raise NotImplementedError("Test {} not implemented".format(testToName[test]))
+            runtime = time() - start_time
+
+            # Keep the set if it passes the threshold and is in the top K
+            summary['num_tested'] += 1
+            if isnan(pval) or -PTOL > pval or pval > 1+PTOL:
+                summary['num_invalid'] += 1
+            elif pvalue_threshold is not None and pval > pvalue_threshold:
+                dropped.append(pval)
+            else:
+                heapq.heappush(heap, (-pval, summary['num_tested'], row, runtime, obs))
+                if top_k is not None and len(heap) > top_k:
+                    dropped.append(-heapq.heappop(heap)[0])
+
+        dropped_counts += np.bincount(log_bins(np.clip(dropped, 0, 1)), minlength=NUM_LOG_BINS)
+
+        # Each worker adds the P-values it computed to the cache, since the
+        # dropped sets are not returned to the parent
+        if cache and newPvals:
+            store_pvalues(cache, newPvals)
 
-# Test the given sets with the given method and test
-def general_test_set_group_wrapper(args): return general_test_set_group(*args)
-def general_test_set_group( sets, geneToCases, num_patients, method, test, statistic, P=None, verbose=0 ):
-    # Construct the arguments to test each set
-    setToPval, setToTime, setToObs = dict(), dict(), dict()
-    num_sets = len(sets)
-    k = len(next(iter(sets)))
-    for i, M in enumerate(sets):
-        # Simple progress bar
         if verbose > 1:
-            sys.stdout.write('\r* Testing {}/{} triples...'.format(i+1, num_sets))
+            sys.stdout.write('\r* Tested {} sets...'.format(num_generated))
             sys.stdout.flush()
 
-        # Do some simple mutation processing
-        sorted_M = sorted(M)
-        X, T, Z, tbl = setToObs[M] = observed_values(sorted_M, num_patients, geneToCases )
-
-        # Compute the saddlepoint approximations
-        start = time()
-        setToPval[M] = general_wre_test( sorted_M, geneToCases, [ P[g] for g in sorted_M ], statistic )
-        setToTime[M] = time() - start
-
-    return setToPval, setToTime, setToObs
+    dropped_counts[-1] += summary['num_pruned']
+    columns = empty_result_columns()
+    for neg_pval, _, row, runtime, obs in heap:
+        append_result(columns, row, -neg_pval, runtime, obs)
+    return results_from_columns(genes, k, columns), dropped_counts, summary
 
-def general_test_sets( sets, geneToCases, num_patients, method, test, statistic, P=None, num_cores=1, verbose=0,
-               report_invalids=False):
+def bounded_test_sets( genes, k, geneToCases, num_patients, method, test, P=None, num_cores=1, verbose=0,
+                       top_k=None, pvalue_threshold=None, cache=None ):
     # Set up the multiprocessing
     num_cores = num_cores if num_cores != -1 else mp.cpu_count()
     if num_cores != 1:
@@ -242,50 +526,154 @@ def general_test_sets( sets, geneToCases, num_patients, method, test, statistic,
     else:
         map_fn = map
 
-    # Split up the sets and run multiprocessing
-    args = [ (sets[i::num_cores], geneToCases, num_patients, method, test, statistic, P, verbose)
+    # Split up the combinations and run multiprocessing
+    args = [ (genes, k, i, num_cores, geneToCases, num_patients, method, test, P, top_k, pvalue_threshold, verbose, cache)
              for i in range(num_cores) ]
-    results = map_fn(general_test_set_group_wrapper, args)
+    results = list(map_fn(bounded_test_set_group_wrapper, args))
 
     if num_cores != 1:
         pool.close()
         pool.join()
 
-    # Combine the dictionaries
-    setToPval, setToTime, setToObs = dict(), dict(), dict()
-    for pval, time, obs in results:
-        setToPval.update(list(pval.items()))
-        setToTime.update(list(time.items()))
-        setToObs.update(list(obs.items()))
+    # Merge the per-worker heaps and counts, keeping the global top K
+    kept = concatenate_results([ worker_results for worker_results, _, _ in results ])
+    kept = select_results(kept, np.argsort(kept['pval'], kind='stable'))
+    dropped_counts = np.add.reduce([ counts for _, counts, _ in results ])
+    summary = dict( (key, sum( worker_summary[key] for _, _, worker_summary in results )) for key in results[0][2] )
+    if top_k is not None and num_results(kept) > top_k:
+        dropped_counts += np.bincount(log_bins(np.clip(kept['pval'][top_k:], 0, 1)), minlength=NUM_LOG_BINS)
+        kept = select_results(kept, slice(0, top_k))
 
-    # Make sure all P-values are numbers
-    tested_sets = len(setToPval)
-    invalid_sets = set( M for M, pval in setToPval.items() if isnan(pval) or -PTOL > pval or pval > 1+PTOL )
+    if verbose > 0:
+        print('- Output {} sets'.format(num_results(kept)))
+        print('\tDropped {} sets with larger P-values'.format(int(dropped_counts.sum())))
+        print('\tRemoved {} sets with NaN or invalid P-values'.format(summary['num_invalid']))
+        print('\tPruned {} sets whose P-value bound is too large'.format(summary['num_pruned']))
+        print('\tIgnored {} sets with Z >= T or a gene with no exclusive mutations'.format(summary['num_sets']-summary['num_tested']-summary['num_pruned']))
+
+    # Compute conservative FDRs, accounting for the dropped sets
+    kept['fdr'] = bounded_multiple_hypothesis_correction(np.clip(kept['pval'], 0.0, 1.0), dropped_counts, method="BY")
+
+    return kept
+
+# Generate the candidate sets of size k from the sets of size k-1 that passed
+# (as sorted tuples of gene indices): the sets all of whose (k-1)-subsets
+# passed. Candidates are joined from two passing sets with the same first k-2
+# genes, and returned in lexicographic order.
+def apriori_candidates( passed, k ):
+    prefixToLast = defaultdict(list)
+    for M in passed:
+        prefixToLast[M[:-1]].append(M[-1])
+    candidates = []
+    for prefix in sorted(prefixToLast.keys()):
+        last = sorted(prefixToLast[prefix])
+        for a, b in combinations(last, 2):
+            M = prefix + (a, b)
+            if all( M[:i] + M[i+1:] in passed for i in range(k-2) ):
+                candidates.append(M)
+    return np.array(candidates, dtype=np.int32).reshape(-1, k)
+
+# Check that every gene of the set has exclusive mutations, which is necessary
+# for the set and all of its supersets to be testable
+def exclusive_genes( M, geneToCases ):
+    return all( set(geneToCases[g]) - set( p for h in M if h != g for p in geneToCases[h] ) for g in M )
+
+# Test the sets of the given sizes level by level, only testing the sets of
+# size k all of whose (k-1)-subsets passed. A set passes if all of its genes
+# have exclusive mutations, which never removes a testable set, so the results
+# are the same as when enumerating every set. If a P-value threshold is given,
+# a set must also have P-value at most the threshold to pass, which prunes
+# more sets but may miss testable sets. The sets that were not tested are then
+# counted with P-value 1 when computing the (conservative) FDRs.
+def apriori_test_sets( genes, ks, geneToCases, num_patients, method, test, P=None, num_cores=1, verbose=0,
+                       report_invalids=False, cache=None, pvalue_threshold=None ):
+    ksToResults = dict()
+    passed = set()
+    for k in range(2, max(ks)+1):
+        if k == 2:
+            candidates = np.array(list(combinations(range(len(genes)), 2)), dtype=np.int32).reshape(-1, 2)
+        else:
+            candidates = apriori_candidates(passed, k)
+        candidates = candidates[[ exclusive_genes([ genes[g] for g in row ], geneToCases) for row in candidates ]]
+        if verbose > 0:
+            print('k={}: {} candidate sets of {}...'.format(k, len(candidates), comb(len(genes), k, exact=True)))
+
+        # Only test the sets we need, either for output or to check the threshold
+        if k in ks or pvalue_threshold is not None:
+            results = test_sets(genes, candidates, geneToCases, num_patients, method, test, P, num_cores,
+                                verbose, report_invalids, cache)
+            if pvalue_threshold is not None:
+                # Count the sets that were not tested in the last bin (P=1)
+                dropped_counts = np.zeros(NUM_LOG_BINS, dtype=np.int64)
+                dropped_counts[-1] = comb(len(genes), k, exact=True) - num_results(results)
+                results['fdr'] = bounded_multiple_hypothesis_correction(np.clip(results['pval'], 0.0, 1.0),
+                                                                        dropped_counts, method="BY")
+                passed = set( tuple(row) for row in results['sets'][results['pval'] <= pvalue_threshold] )
+            if k in ks:
+                ksToResults[k] = results
+        if pvalue_threshold is None:
+            passed = set( tuple(row) for row in candidates )
+
+    return ksToResults
 
-    # Report invalid sets
-    if verbose > 0 and report_invalids:
-        sys.stderr.write('- Found {} sets with invalid P-values\n'.format(len(invalid_sets)))
-        invalid_rows = []
-        for M in invalid_sets:
-            X, T, Z, tbl = setToObs[M]
-            invalid_rows.append([ ','.join(sorted(M)), T, Z, tbl, setToPval[M] ])
-        sys.stderr.write( '\t' + '\n\t '.join([ '\t'.join(map(str, row)) for row in invalid_rows ]) + '\n' )
+# Test the given sets with the given method and test
+def general_test_set_group_wrapper(args): return general_test_set_group(*args)
+def general_test_set_group( genes, sets, geneToCases, num_patients, method, test, statistic, P=None, verbose=0, cache=None,
+                            batch_size=10000 ):
+    # Construct the arguments to test each set
+    columns = empty_result_columns()
+    num_sets, k = np.shape(sets)
+    for batch_start in range(0, num_sets, batch_size):
+        batch = [ tuple( genes[g] for g in row ) for row in sets[batch_start:batch_start+batch_size] ]
+        cachedPvals = load_cached_pvalues(cache, batch) if cache else dict()
+        for i, sorted_M in enumerate(batch):
+            # Simple progress bar
+            if verbose > 1:
+                sys.stdout.write('\r* Testing {}/{} triples...'.format(batch_start+i+1, num_sets))
+                sys.stdout.flush()
+
+            # Do some simple mutation processing
+            obs = observed_values(sorted_M, num_patients, geneToCases )
+
+            # Use the P-value from the cache if we have it, otherwise
+            # compute the saddlepoint approximations
+            start = time()
+            if sorted_M in cachedPvals:
+                pval = cachedPvals[sorted_M]
+            else:
+                pval = general_wre_test( sorted_M, geneToCases, [ P[g] for g in sorted_M ], statistic )
+            append_result(columns, sets[batch_start+i], pval, time() - start if sorted_M not in cachedPvals else 0., obs)
 
-    setToPval = dict( (M, pval) for M, pval in setToPval.items() if not M in invalid_sets )
-    setToTime = dict( (M, runtime) for M, runtime in setToTime.items() if not M in invalid_sets )
-    setToObs = dict( (M, obs) for M, obs in setToObs.items() if not M in invalid_sets )
+    return results_from_columns(genes, k, columns)
 
-    if verbose > 0:
-        print('- Output {} sets'.format(len(setToPval)))
-        print('\tRemoved {} sets with NaN or invalid P-values'.format(len(invalid_sets)))
-        print('\tIgnored {} sets with Z >= T or a gene with no exclusive mutations'.format(len(sets)-tested_sets))
+def general_test_sets( genes, sets, geneToCases, num_patients, method, test, statistic, P=None, num_cores=1, verbose=0,
+               report_invalids=False, cache=None, checkpoint_dir=None, checkpoint_size=CHECKPOINT_NUM_SETS, num_omitted=0):
+    # Set up the multiprocessing
+    num_cores = num_cores if num_cores != -1 else mp.cpu_count()
+    if num_cores != 1:
+        pool = mp.Pool(num_cores)
+        map_fn = pool.map
+    else:
+        map_fn = map
 
-    # Compute the FDRs
-    tested_sets = list(setToPval.keys())
-    pvals = [ min(max(0.0, setToPval[M]), 1.0) for M in tested_sets ]
-    setToFDR = dict(list(zip(tested_sets, multiple_hypothesis_correction(pvals, method="BY"))))
+    # Split up the sets and run multiprocessing
+    def test_block( block ):
+        args = [ (genes, block[i::num_cores], geneToCases, num_patients, method, test, statistic, P, verbose, cache)
+                 for i in range(num_cores) ]
+        return list(map_fn(general_test_set_group_wrapper, args))
+
+    if checkpoint_dir:
+        params = dict(genes=checkpoint_digest(genes), data=mutation_data_digest(genes, geneToCases, num_patients, P),
+                      method=method, test=test, statistic=statistic)
+        results = list(tested_blocks(test_block, genes, sets, checkpoint_size, params, checkpoint_dir))
+    else:
+        results = test_block(sets)
 
-    return setToPval, setToTime, setToFDR, setToObs
+    if num_cores != 1:
+        pool.close()
+        pool.join()
+
+    return merge_test_results(results, len(sets), verbose, report_invalids, cache, clip_pvals=True, num_omitted=num_omitted)
 
 ################################################################################
 # Helpers
@@ -293,3 +681,52 @@ def general_test_sets( sets, geneToCases, num_patients, method, test, statistic,
 # Testable set
 def testable_set( k, T, Z, tbl ):
     return T > Z and all( tbl[2**i] > 0 for i in range(k) )
+
+# Shard i of n (counting from 1), given as "i/n"
+def parse_shard( shard ):
+    i, n = map(int, shard.split('/'))
+    if not 1 <= i <= n:
+        raise ValueError('Invalid shard "{}": expected i/n with 1 <= i <= n'.format(shard))
+    return i, n
+
+# Range of ranks [start, stop) of the sets in the given shard
+def shard_ranks( num_sets, shard ):
+    i, n = shard
+    return (i-1)*num_sets//n, i*num_sets//n
+
+# Combination of range(n) with the given rank in the (lexicographic) order of
+# itertools.combinations
+def unrank_combination( rank, n, k ):
+    combination, x = [], 0
+    for j in range(k, 0, -1):
+        # Skip the combinations starting with x
+        while comb(n-x-1, j-1, exact=True) <= rank:
+            rank -= comb(n-x-1, j-1, exact=True)
+            x += 1
+        combination.append(x)
+        x += 1
+    return combination
+
+# Iterate over the k-subsets of range(n) with ranks start, ..., stop-1, in the
+# same order as itertools.combinations
+def combinations_from_rank( n, k, start, stop ):
+    if start >= stop:
+        return
+    combination = unrank_combination(start, n, k)
+    for _ in range(start, stop):
+        yield tuple(combination)
+
+        # Move to the next combination
+        i = k-1
+        while i >= 0 and combination[i] == n-k+i:
+            i -= 1
+        if i < 0:
+            return
+        combination[i] += 1
+        for j in range(i+1, k):
+            combination[j] = combination[j-1] + 1
+
+# Matrix of the k-subsets of range(n) with ranks start, ..., stop-1
+def combination_matrix( n, k, start=0, stop=None ):
+    stop = comb(n, k, exact=True) if stop is None else stop
+    return np.array(list(combinations_from_rank(n, k, start, stop)), dtype=np.int32).reshape(-1, k)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+# Load required modules
+import numpy as np
+from collections import defaultdict
+from itertools import product
+from .results import *
+
+# Genes mutated in exactly the same patients (and with the same weights, for
+# WRE) are interchangeable in the RE and WRE tests: a gene set has the same
+# P-value if a gene is replaced by another gene of its class. A set with two
+# genes of the same class has no exclusive mutations in one of them, so it is
+# never testable. We can therefore test the sets of class representatives
+# (the first gene of each class) and expand each result to the sets of
+# members of the same classes.
+def gene_equivalence_classes( genes, geneToCases, geneToP=None ):
+    keyToMembers = defaultdict(list)
+    for g in sorted(genes):
+        key = frozenset(geneToCases[g])
+        if geneToP is not None:
+            key = (key, np.ascontiguousarray(geneToP[g], dtype=np.float64).tobytes())
+        keyToMembers[key].append(g)
+    return dict( (members[0], members) for members in keyToMembers.values() )
+
+# Expand results over the class representatives to results over all the
+# genes of the classes. The genes of the expanded sets are sorted, so X and
+# the contingency tables are permuted to match. The saddlepoint P-values
+# depend (slightly) on the order of the genes, so a set whose genes are not
+# in the order of their representatives can have a different P-value. For
+# each result and each such order, retest is called with one set of members
+# in that order (as a row of indices into the sorted genes of the classes),
+# and returns its P-value, which is shared by the sets in the same order.
+def expand_results( results, representativeToMembers, retest=None ):
+    genes = sorted( g for members in representativeToMembers.values() for g in members )
+    geneToIndex = dict( (g, i) for i, g in enumerate(genes) )
+    k = results['sets'].shape[1]
+    columns = empty_result_columns()
+    fdr = []
+    orderToRetest, retest_sets, retest_rows = dict(), [], []
+    for i in range(num_results(results)):
+        X, T, Z, tbl = result_observed(results, i)
+        for M in product(*[ representativeToMembers[g] for g in result_genes(results, i) ]):
+            order = sorted(range(len(M)), key=lambda j: M[j])
+            expanded_tbl = [ tbl[sum( 1 << order[j] for j in range(len(M)) if t & (1 << j) )] for t in range(len(tbl)) ]
+            append_result(columns, [ geneToIndex[M[j]] for j in order ], results['pval'][i], results['runtime'][i],
+                          ([ X[j] for j in order ], T, Z, expanded_tbl))
+            fdr.append(results['fdr'][i])
+
+            # Record the sets that need to be tested again in their order
+            if retest is not None and order != list(range(k)):
+                if (i, tuple(order)) not in orderToRetest:
+                    orderToRetest[(i, tuple(order))] = len(retest_sets)
+                    retest_sets.append(columns['sets'][-1])
+                retest_rows.append((len(columns['pval'])-1, orderToRetest[(i, tuple(order))]))
+
+    if retest_sets:
+        pvals = retest(np.array(retest_sets, dtype=np.int32).reshape(-1, k))
+        for row, j in retest_rows:
+            columns['pval'][row] = pvals[j]
+    return results_from_columns(genes, k, columns, fdr)
@@ -4,6 +4,8 @@
 import sys, os, json, numpy as np
 from collections import defaultdict
 from .constants import *
+from .results import *
+from .results_archive import *
 
 # Load mutation data from one of our processed JSON file
 def load_mutation_data( mutation_file, min_freq=1 ):
@@ -45,32 +47,55 @@ def create_tbl_header( k ):
     bin_format = 't{0:0%sb}' % k
     return '\t'.join([ bin_format.format(i) for i in range(2**k) ])
 
-# Output a run to file as a table or JSON file
-def output_enumeration_table(args, k, setToPval, setToRuntime, setToFDR, setToObs, fdr_threshold=1 ):
+# Converts columnar results to dictionaries keyed by the tab-separated genes
+# of each set, so they can be output as JSON
+def convert_results_for_json( results, sep='\t' ):
+    keys = [ sep.join(result_genes(results, i)) for i in range(num_results(results)) ]
+    output = dict(setToPval=dict(zip(keys, results['pval'].tolist())),
+                  setToObs=dict( (key, result_observed(results, i)) for i, key in enumerate(keys) ),
+                  setToRuntime=dict(zip(keys, results['runtime'].tolist())))
+    if not np.all(np.isnan(results['fdr'])):
+        output['setToFDR'] = dict(zip(keys, results['fdr'].tolist()))
+    return output
+
+# Results archive of the sets of size k of a run
+def enumeration_archive_file( args, k ):
+    return '{}-k{}{}'.format(args.output_prefix, k, RESULTS_ARCHIVE_EXTENSION)
+
+# Output a run to file as a table, JSON file or results archive
+def output_enumeration_table(args, k, results, fdr_threshold=1 ):
     is_permutational = nameToTest[args.test] == RCE
+
+    # Results archive, in chunks sorted ascending by P-value
+    if getattr(args, 'binary_format', False):
+        indices = np.flatnonzero(results['fdr'] <= fdr_threshold)
+        indices = indices[np.argsort(results['pval'][indices], kind='stable')]
+        archive_file = enumeration_archive_file(args, k)
+        create_results_archive(archive_file, results['genes'], vars(args))
+        append_results_archive(archive_file, select_results(results, indices))
+        return
+
     extension = 'json' if args.json_format else 'tsv'
     with open('{}-k{}.{}'.format(args.output_prefix, k, extension), 'w') as OUT:
         # Tab-separated
         if not args.json_format:
-            # Construct the rows
-            rows = []
-            for M, pval in setToPval.items():
-                if setToFDR[M]<=fdr_threshold:
-                    X, T, Z, tbl = setToObs[M]
-                    row = [ ', '.join(sorted(M)), pval, setToFDR[M], setToRuntime[M], T, Z ] + tbl
-                    rows.append( row )
-            rows.sort(key=lambda row: row[1]) # sort ascending by P-value
+            # Sort ascending by P-value the sets passing the FDR threshold
+            indices = np.flatnonzero(results['fdr'] <= fdr_threshold)
+            indices = indices[np.argsort(results['pval'][indices], kind='stable')]
 
             # Create the header
             method_paren = '' if is_permutational else ' ({})'.format(args.method)
-            k = len(rows[0][0].split(', '))
             tbl_header = create_tbl_header( k )
             header = 'Gene set\t{0}{1} P-value\t{0}{1} FDR\t{0}{1} '\
                      'Runtime\tT\tZ\t{2}'.format(args.test, method_paren, tbl_header)
 
-            # Output to file
-            OUT.write('#{}\n'.format(header))
-            OUT.write( '\n'.join([ '\t'.join(map(str, row)) for row in rows ]) )
+            # Output to file, one row at a time
+            OUT.write('#{}'.format(header))
+            for i in indices:
+                X, T, Z, tbl = result_observed(results, i)
+                row = [ ', '.join(result_genes(results, i)), float(results['pval'][i]), float(results['fdr'][i]),
+                        float(results['runtime'][i]), T, Z ] + tbl
+                OUT.write('\n' + '\t'.join(map(str, row)))
 
         # JSON
         else:
@@ -78,28 +103,48 @@ def output_enumeration_table(args, k, setToPval, setToRuntime, setToFDR, setToOb
             params = vars(args)
 
             # Output to file
-            output = dict(params=params, setToPval=convert_dict_for_json(setToPval),
-                          setToObs=convert_dict_for_json(setToObs),
-                          setToFDR=convert_dict_for_json(setToFDR),
-                          setToRuntime=convert_dict_for_json(setToRuntime))
+            output = dict(params=params, **convert_results_for_json(results))
             json.dump( output, OUT )
 
 # Output MCMC
-def output_mcmc(args, setsToFreq, setToPval, setToObs):
-    if args.json_format:
+def output_mcmc(args, collections, results, diagnostics=None):
+    if getattr(args, 'binary_format', False):
+        # Sort the sets ascending by P-value, and update the collections to
+        # index the sorted sets
+        order = np.argsort(results['pval'], kind='stable')
+        rank = np.empty(len(order), dtype=np.int32)
+        rank[order] = np.arange(len(order), dtype=np.int32)
+        sets = np.where(collections['sets'] >= 0, rank[collections['sets']], -1)
         params = vars(args)
-        output = dict(params=params, setToPval=convert_dict_for_json(setToPval),
-                      setToObs=convert_dict_for_json(setToObs),
-                      setsToFreq=dict( (' '.join([ ','.join(sorted(M)) for M in sets ]), freq) for sets, freq in setsToFreq.items()) )
+        if diagnostics:
+            params = dict(params, diagnostics=diagnostics)
+        archive_file = args.output_prefix + RESULTS_ARCHIVE_EXTENSION
+        create_results_archive(archive_file, results['genes'], params)
+        append_results_archive(archive_file, select_results(results, order))
+        append_collections_archive(archive_file, dict(sets=sets.astype(np.int32), freq=collections['freq']))
+    elif args.json_format:
+        params = vars(args)
+        output = convert_results_for_json(results)
+        del output['setToRuntime']
+        output.update(params=params,
+                      setsToFreq=dict( (' '.join([ ','.join(result_genes(results, i)) for i in sets if i >= 0 ]), int(freq))
+                                       for sets, freq in zip(collections['sets'], collections['freq']) ))
+        if diagnostics:
+            # R-hat is undefined (NaN) with a single chain
+            checks = [ dict( (key, None if value != value else value) for key, value in check.items() )
+                       for check in diagnostics['checks'] ]
+            output['diagnostics'] = dict(diagnostics, checks=checks)
         with open(args.output_prefix + '.json', 'w') as OUT:
             json.dump( output, OUT )
     else:
         # Output a gene set file
         with open(args.output_prefix + '-sampled-collections.tsv', 'w') as OUT:
+            weights = -np.log10(results['pval'] ** args.alpha)
             rows = []
-            for sets, freq in setsToFreq.items():
-                row = [ ' '.join([ ','.join(M) for M in sets ]), freq ]
-                row.append( sum( -np.log10(setToPval[M] ** args.alpha) for M in sets ))
+            for sets, freq in zip(collections['sets'], collections['freq']):
+                sets = sets[sets >= 0]
+                row = [ ' '.join([ ','.join(result_genes(results, i)) for i in sets ]), int(freq) ]
+                row.append( sum( float(weights[i]) for i in sets ))
                 rows.append(row)
             rows.sort(key=lambda r: r[1], reverse=True)
 
@@ -108,13 +153,17 @@ def output_mcmc(args, setsToFreq, setToPval, setToObs):
 
         # Output each of the sample gene sets
         with open(args.output_prefix + '-sampled-sets.tsv', 'w') as OUT:
-            rows = []
-            for M, pval in setToPval.items():
-                X, T, Z, tbl = setToObs[M]
-                rows.append([ ','.join(sorted(M)), pval, T, Z] + tbl )
-            rows.sort(key=lambda r: r[1])
             k = max(args.gene_set_sizes)
-
             tbl_header = create_tbl_header( k )
-            OUT.write('#Gene set\t{} ({}) P-value\tT\tZ\t{}\n'.format(args.test, args.method, tbl_header))
-            OUT.write( '\n'.join([ '\t'.join(map(str, row)) for row in rows ]) )
+            OUT.write('#Gene set\t{} ({}) P-value\tT\tZ\t{}'.format(args.test, args.method, tbl_header))
+            for i in np.argsort(results['pval'], kind='stable'):
+                X, T, Z, tbl = result_observed(results, i)
+                row = [ ','.join(result_genes(results, i)), float(results['pval'][i]), T, Z ] + tbl
+                OUT.write('\n' + '\t'.join(map(str, row)))
+
+        # Output the convergence diagnostics checked after each segment
+        if diagnostics:
+            with open(args.output_prefix + '-diagnostics.tsv', 'w') as OUT:
+                rows = [ [ check['iterations'], check['rhat_weight'], check['rhat_top'], check['ess'] ] for check in diagnostics['checks'] ]
+                OUT.write('#Iterations\tR-hat (weight)\tR-hat (top collections)\tESS\n')
+                OUT.write( '\n'.join([ '\t'.join(map(str, row)) for row in rows ]) )
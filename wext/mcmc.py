@@ -1,147 +1,380 @@
 #!/usr/bin/env python
 
-import sys, os, numpy as np
+import sys, os, numpy as np, multiprocessing as mp
 from collections import defaultdict
 from time import time
-from random import random, sample, choice, seed as random_seed
+from random import Random, sample, seed as random_seed, randint
 from past.builtins import xrange
 
 from .constants import *
 from .enumerate_sets import observed_values
 from .exclusivity_tests import re_test, wre_test
+from .cache import load_cached_pvalues, store_pvalues
+from .results import *
 
-def mcmc(ks, geneToCases, num_patients, method, test, geneToP, seed, annotations=set(), verbose=0, step_len=100, nchains=1, niters=1000, alpha=1):
-    if verbose > 0: 
+def mcmc(ks, geneToCases, num_patients, method, test, geneToP, seed, annotations=set(), verbose=0, step_len=100, nchains=1, niters=1000, alpha=1,
+         num_cores=1, segment_len=None, rhat_threshold=None, min_ess=None, num_top=10, temperatures=None, swap_interval=None,
+         cache=None):
+    if verbose > 0:
         print('-' * 33, 'Running MCMC', '-' * 33)
 
-    # Set up a local version of the weight function
-    if test == WRE:
-        def _test(M, X, T, Z, tbl):
-            return wre_test(T, X, [ geneToP[g] for g in M ], method=method)
-    elif test == RE:
-        def _test(M, X, T, Z, tbl):
-            return re_test(T, X, tbl, method=method)
-    else:
+    if test not in (WRE, RE):
         raise NotImplementedError('Test "{}" not implemented with MCMC'.format(testToName[test]))
 
-    def _weight(M):
-        if M not in setToPval:
-            setToPval[M] = _test(M, *setToObs[M])
-        return -np.log10(setToPval[M]**alpha)
-
-    def _valid_set(M):
-        # Compute or retrieve the observed statistics
-        M = frozenset(M)
-        if M not in setToObs:
-            setToObs[M] = observed_values(M, num_patients, geneToCases)
-        X, T, Z, tbl = setToObs[M]
-
-        # We don't allow sets with T <= Z or with multiple annotations
-        # (since these are often trivially exclusive)
-        if T <= Z or len(M & annotations) > 1:
-            return False
-        else:
-            return True
+    # With parallel tempering, each chain is a ladder of replicas at the given
+    # temperatures (the first being 1), which run at the same time and swap
+    # states every swap_interval iterations. We only sample from the replica at
+    # temperature 1.
+    if temperatures is None:
+        temperatures = [1.]
+    num_temperatures = len(temperatures)
 
-    def _collection_weight(collection):
-        return sum( _weight(M) for M in collection )
+    # Each replica has its own PRNG, and the replicas swap states every
+    # swap_interval iterations, so the samples do not depend on the number of
+    # cores or the segment length
+    random_seed(seed)
+    chain_states = [ dict(seed=randint(0, 2**31), itera=0, beta=1./T) for _ in xrange(nchains) for T in temperatures ]
+    swap_rng = Random(randint(0, 2**31))
+    swap_attempts, swap_accepts = [0] * (num_temperatures-1), [0] * (num_temperatures-1)
 
-    def _to_collection(solution):
-        return frozenset( frozenset(M) for M in solution.values() ) 
+    # Run the chains in parallel, in segments of segment_len iterations.
+    # Between segments, we merge the p-values and observed values computed by
+    # each chain, and pass the new ones on to every chain in the next segment.
+    # We also check convergence between segments, and stop early (before
+    # niters iterations) once the given thresholds are met.
+    if segment_len is None:
+        segment_len = int(np.ceil(niters / 10.))
+    if swap_interval is None:
+        swap_interval = int(np.ceil(niters / 10.))
+    worker_args = (ks, geneToCases, num_patients, method, test, geneToP, annotations, alpha, step_len, cache)
+    num_cores = min(num_cores if num_cores != -1 else mp.cpu_count(), len(chain_states))
+    if num_cores != 1:
+        pool = mp.Pool(num_cores, initializer=init_chain_worker, initargs=worker_args)
+        map_fn = pool.map
+    else:
+        init_chain_worker(*worker_args)
+        map_fn = map
 
-    # Compute the acceptance ratio
-    def _log_accept_ratio( W_current, W_next ): 
-        return W_next - W_current
+    genespace = sorted(geneToCases.keys())
+    def _to_genes(key):
+        return frozenset( genespace[g] for g in key )
 
-    # Set up PRNG, sample space, and output
-    random_seed(seed)
-    t          = len(ks)
-    genespace  = list(geneToCases.keys())
     setsToFreq = [ defaultdict(int) for _ in xrange(nchains) ]
-    setToPval, setToObs =  dict(), dict()
-    for c in xrange(nchains):
-        if verbose > 0: 
-            print('- Experiment', c+1)
-
-        # Seed Markov chain
-        soln, assigned = choose_random_set(ks, genespace)
-        while not all( _valid_set(M) for M in _to_collection(soln) ):
-            soln, assigned = choose_random_set(ks, genespace)
-        weight = _collection_weight( _to_collection(soln) )
-
-        # Run MCMC
-        progress_step = float(np.ceil(niters / 72.))
-        itera = 0
-        while itera < niters:
-            # Simple progress bar
-            if verbose > 0 and (itera % progress_step == 0):
-                sys.stdout.write("\r[%-72s] %d%%" % ('='*int(np.ceil(itera / progress_step)) + '>', int(np.ceil(100.*itera / niters))))
-                sys.stdout.flush()
-
-            # Sample the next gene to swap in/around the set
-            next_soln = dict( (index, set(M)) for index, M in soln.items() )
-            next_assigned = dict(list(assigned.items()))
-            next_gene = choice(genespace)
-
-            # There are two possibilities for the next gene
-            # 1) The gene we sampled is already in the current solution. In this
-            #    case, we swap the gene with another gene in a different set.
-            if next_gene in next_assigned:
-                # if we only have one set, we can't swap between sets
-                if t == 1: continue
-                i = next_assigned[next_gene]
-                swap_gene = choice([ g for g in next_assigned.keys() if g not in next_soln[i] ])
-                j = next_assigned[swap_gene]
-                next_assigned[swap_gene] = i
-                next_soln[i].add(swap_gene)
-                next_soln[i].remove( next_gene )
-                next_assigned[next_gene] = j
-                next_soln[j].remove(swap_gene)
-                next_soln[j].add(next_gene)
-
-                if not (_valid_set(next_soln[j]) and _valid_set(next_soln[i])):
-                    continue
-
-            # 2) The gene is not in the current solution. In this case, we choose
-            #    a random gene in the solution to remove, and add the next gene.
-            else:
-                swap_gene = choice(list(next_assigned.keys()))
-                j = next_assigned[swap_gene]
-                del next_assigned[swap_gene]
-                next_assigned[next_gene] = j
-                next_soln[j].remove(swap_gene)
-                next_soln[j].add(next_gene)
-
-                if not _valid_set(next_soln[j]): 
-                    continue
-
-            # Compare the current soln to the next soln
-            next_weight = _collection_weight(_to_collection(next_soln))
-            if _log_accept_ratio( weight, next_weight ) >= np.log10(random()):
-                soln, weight, assigned = next_soln, next_weight, next_assigned
-
-            # Freeze sets after thinning the chain a certain number of iterations
-            itera += 1
-            if (itera+1) % step_len == 0:
-                setsToFreq[c][_to_collection(soln)] += 1
+    samples = [ [] for _ in xrange(nchains) ]
+    sample_weights = [ [] for _ in xrange(nchains) ]
+    checks, converged = [], False
+    setToPval, setToObs = dict(), dict()
+    newPvals, newObs = dict(), dict()
+    itera = 0
+    while itera < niters:
+        # Simple progress bar
+        if verbose > 0:
+            sys.stdout.write("\r[%-72s] %d%%" % ('='*int(72.*itera / niters) + '>', int(np.ceil(100.*itera / niters))))
+            sys.stdout.flush()
+
+        # Run the segment in rounds that end at the replica swaps, which are
+        # every swap_interval iterations whatever the segment length
+        segment_end = min(itera + segment_len, niters)
+        segmentPvals = dict()
+        while itera < segment_end:
+            next_swap = (itera // swap_interval + 1)*swap_interval if num_temperatures > 1 else niters
+            num_round = min(segment_end, next_swap) - itera
+            tasks = [ (state, num_round, newPvals, newObs) for state in chain_states ]
+            newPvals, newObs = dict(), dict()
+            for r, (state, chain_samples, chain_weights, chainPvals, chainObs) in enumerate(map_fn(run_chain_segment, tasks)):
+                chain_states[r] = state
+                c, k = divmod(r, num_temperatures)
+                if k == 0:
+                    for collection in chain_samples:
+                        setsToFreq[c][collection] += 1
+                    samples[c].extend(chain_samples)
+                    sample_weights[c].extend(chain_weights)
+                for M, pval in chainPvals.items():
+                    if M not in setToPval:
+                        setToPval[M] = newPvals[M] = segmentPvals[M] = pval
+                for M, obs in chainObs.items():
+                    if M not in setToObs:
+                        setToObs[M] = newObs[M] = obs
+            itera += num_round
+
+            # Propose swaps between the states of replicas at adjacent
+            # temperatures, accepting with the Metropolis ratio of the exchange
+            if itera == next_swap:
+                for c in xrange(nchains):
+                    for k in xrange(num_temperatures-1):
+                        cold, hot = chain_states[c*num_temperatures+k], chain_states[c*num_temperatures+k+1]
+                        swap_attempts[k] += 1
+                        if (cold['beta'] - hot['beta'])*_log_accept_ratio(cold['weight'], hot['weight']) >= np.log10(swap_rng.random()):
+                            cold['genes'], hot['genes'] = hot['genes'], cold['genes']
+                            cold['weight'], hot['weight'] = hot['weight'], cold['weight']
+                            swap_accepts[k] += 1
+
+        # Add the new P-values to the persistent cache
+        if cache:
+            store_pvalues(cache, dict( (_to_genes(key), pval) for key, pval in segmentPvals.items() ))
+
+        # Check convergence on the collection weights and the indicators of
+        # the most frequently sampled collections
+        check = convergence_diagnostics(samples, sample_weights, num_top)
+        check['iterations'] = itera
+        checks.append(check)
+        converged = (rhat_threshold is not None or min_ess is not None) and \
+                    (rhat_threshold is None or (check['rhat_weight'] < rhat_threshold and check['rhat_top'] < rhat_threshold)) and \
+                    (min_ess is None or check['ess'] >= min_ess)
+        if converged:
+            break
 
+    if num_cores != 1:
+        pool.close()
+        pool.join()
+
+    if verbose > 0:
+        print('\r[' + ('='*71) + '>] 100%')
+        print('- Iterations: {} (R-hat weight: {rhat_weight:.4f}, R-hat top collections: {rhat_top:.4f}, '\
+              'ESS: {ess:.1f}){}'.format(itera, ' converged' if converged else '', **checks[-1]))
+    diagnostics = dict(iterations=itera, converged=converged, checks=checks)
+    if num_temperatures > 1:
+        diagnostics['temperatures'] = list(temperatures)
+        diagnostics['swap_interval'] = swap_interval
+        diagnostics['swap_rates'] = [ float(a)/n for a, n in zip(swap_accepts, swap_attempts) ]
         if verbose > 0:
-            print('\r[' + ('='*71) + '>] 100%')
+            print('- Swap acceptance rates:', ', '.join( '{:.3f}'.format(rate) for rate in diagnostics['swap_rates'] ))
+
+    # Merge the various chains into columnar results over the sorted genes:
+    # the sets with their P-values, and the collections as rows of indices
+    # into the sets with their total frequencies
+    columns = empty_result_columns()
+    keyToRow = dict()
+    for key, pval in setToPval.items():
+        keyToRow[key] = len(keyToRow)
+        append_result(columns, key, pval, 0., setToObs[key])
+    results = results_from_columns(genespace, max(ks), columns)
 
-    # Merge the various chains
-    setsToTotalFreq = defaultdict(int)
+    collectionToFreq = defaultdict(int)
     for counter in setsToFreq:
-        for sets, freq in counter.items():
-            setsToTotalFreq[sets] += freq
-
-    return setsToTotalFreq, setToPval, setToObs
-
-# Choose a random set to initialize with
-def choose_random_set(ks,  genespace):
-    num_sampled_genes, t = sum(ks), len(ks)
-    initial_genes = sample(genespace, num_sampled_genes)
-    soln, assigned = dict(), dict()
-    for i in range(t):
-        soln[i] = set(initial_genes[sum(ks[:i]):sum(ks[:i+1])])
-        for g in soln[i]: assigned[g] = i
-    return soln, assigned
+        for collection, freq in counter.items():
+            collectionToFreq[collection] += freq
+    collections = dict(sets=np.full((len(collectionToFreq), len(ks)), -1, dtype=np.int32),
+                       freq=np.array(list(collectionToFreq.values()), dtype=np.int64))
+    for i, collection in enumerate(collectionToFreq):
+        collections['sets'][i, :len(collection)] = [ keyToRow[key] for key in collection ]
+
+    return collections, results, diagnostics
+
+# Gelman-Rubin potential scale reduction factor of the given traces (one per
+# chain, of equal length), using the second half of each trace
+def gelman_rubin(traces):
+    traces = np.asarray(traces, dtype=np.float64)
+    if traces.ndim != 2 or traces.shape[0] < 2 or traces.shape[1] < 4:
+        return float('nan')
+    traces = traces[:, traces.shape[1]//2:]
+    n = traces.shape[1]
+    W = np.mean(np.var(traces, axis=1, ddof=1))
+    B = n*np.var(np.mean(traces, axis=1), ddof=1)
+    if W == 0:
+        return 1. if B == 0 else float('inf')
+    return float(np.sqrt(((n-1.)/n*W + B/n)/W))
+
+# Effective sample size of the given traces, summed over chains. We estimate
+# the autocorrelation time of each chain with Geyer's initial positive
+# sequence. Constant traces count as a single sample.
+def effective_sample_size(traces):
+    ess = 0.
+    for x in traces:
+        x = np.asarray(x, dtype=np.float64)
+        n = len(x)
+        x = x - x.mean()
+        if n < 4 or not np.any(x):
+            ess += min(n, 1)
+            continue
+        f = np.fft.rfft(x, 2*n)
+        acf = np.fft.irfft(f*np.conj(f))[:n]
+        acf /= acf[0]
+        pairs = acf[:n-1:2] + acf[1:n:2]
+        num_positive = np.argmax(pairs <= 0) if np.any(pairs <= 0) else len(pairs)
+        tau = max(-1. + 2.*np.sum(pairs[:num_positive]), 1./n)
+        ess += n/tau
+    return float(ess)
+
+# Gelman-Rubin R-hat of the indicators of a collection in each chain. If some
+# chain never sampled the collection (in the half of the traces used), the
+# chains disagree on it and R-hat is infinite: for a rare collection, R-hat of
+# the indicators would otherwise be close to 1.
+def indicator_gelman_rubin(samples, collection, num_samples):
+    traces = [ [ sample == collection for sample in chain_samples[:num_samples] ] for chain_samples in samples ]
+    if len(traces) > 1 and not all( any(trace[num_samples//2:]) for trace in traces ):
+        return float('inf')
+    return gelman_rubin(traces)
+
+# Compute the convergence diagnostics of the sampled collections and their weights
+def convergence_diagnostics(samples, sample_weights, num_top=10):
+    num_samples = min( len(chain_samples) for chain_samples in samples )
+    totalFreq = defaultdict(int)
+    for chain_samples in samples:
+        for collection in chain_samples:
+            totalFreq[collection] += 1
+    top = sorted(totalFreq, key=lambda collection: -totalFreq[collection])[:num_top]
+    rhat_top = [ indicator_gelman_rubin(samples, top_collection, num_samples) for top_collection in top ]
+    return dict(rhat_weight=gelman_rubin([ w[:num_samples] for w in sample_weights ]),
+                rhat_top=float(np.max(rhat_top)) if rhat_top else float('nan'),
+                ess=effective_sample_size(sample_weights))
+
+# Data shared by the chains run in each process, and the cache of p-values and
+# observed values computed or received by the process
+_chain_data = dict()
+_setToPval, _setToObs = dict(), dict()
+_computedPvals, _computedObs = dict(), dict()
+
+# Genes are represented by their index in genespace, and gene sets by the
+# sorted tuple of their indices
+def init_chain_worker(ks, geneToCases, num_patients, method, test, geneToP, annotations, alpha, step_len, cache=None):
+    genespace = sorted(geneToCases.keys())
+    _chain_data.update(ks=ks, geneToCases=geneToCases, num_patients=num_patients, method=method, test=test,
+                       geneToP=geneToP, alpha=alpha, step_len=step_len, genespace=genespace, cache=cache,
+                       annotations=set( g for g, gene in enumerate(genespace) if gene in annotations ))
+    _setToPval.clear()
+    _setToObs.clear()
+
+def _weight(key):
+    if key not in _setToPval:
+        X, T, Z, tbl = _setToObs[key]
+        M = tuple( _chain_data['genespace'][g] for g in key )
+        cachedPvals = load_cached_pvalues(_chain_data['cache'], [M]) if _chain_data['cache'] else dict()
+        if cachedPvals:
+            pval = cachedPvals[M]
+        elif _chain_data['test'] == WRE:
+            pval = wre_test(T, X, [ _chain_data['geneToP'][g] for g in M ], method=_chain_data['method'])
+        else:
+            pval = re_test(T, X, tbl, method=_chain_data['method'])
+        _setToPval[key] = _computedPvals[key] = pval
+    return -np.log10(_setToPval[key]**_chain_data['alpha'])
+
+def _valid_set(key):
+    # Compute or retrieve the observed statistics
+    if key not in _setToObs:
+        M = tuple( _chain_data['genespace'][g] for g in key )
+        _setToObs[key] = _computedObs[key] = observed_values(M, _chain_data['num_patients'], _chain_data['geneToCases'])
+    X, T, Z, tbl = _setToObs[key]
+
+    # We don't allow sets with T <= Z or with multiple annotations
+    # (since these are often trivially exclusive)
+    if T <= Z or sum( g in _chain_data['annotations'] for g in key ) > 1:
+        return False
+    else:
+        return True
+
+# Compute the acceptance ratio
+def _log_accept_ratio( W_current, W_next ):
+    return W_next - W_current
+
+# Run a single chain for the given number of iterations from the given state,
+# returning the new state, the sampled collections, and the p-values and
+# observed values that were not in the cache.
+# The state is the list of genes in the collection, where the i-th set holds
+# the genes at positions offsets[i] to offsets[i+1]. Moves swap or replace
+# genes in place, so only the weights of the (one or two) changed sets are
+# recomputed, and rejected moves are reverted.
+def run_chain_segment(args):
+    state, niters, newPvals, newObs = args
+    _setToPval.update(newPvals)
+    _setToObs.update(newObs)
+    _computedPvals.clear()
+    _computedObs.clear()
+
+    ks, step_len, beta = _chain_data['ks'], _chain_data['step_len'], state['beta']
+    t, num_genes, num_sampled_genes = len(ks), len(_chain_data['genespace']), sum(ks)
+    offsets = [ sum(ks[:i]) for i in range(t+1) ]
+    set_of = [ i for i in range(t) for _ in range(ks[i]) ]
+    rng = Random()
+    if 'rng_state' in state:
+        rng.setstate(state['rng_state'])
+    else:
+        rng.seed(state['seed'])
+
+    def _key(i):
+        return tuple(sorted(genes[offsets[i]:offsets[i+1]]))
+
+    # Seed Markov chain
+    if 'genes' in state:
+        genes = state['genes']
+    else:
+        genes = choose_random_set(ks, num_genes, rng)
+        while not all( _valid_set(_key(i)) for i in range(t) ):
+            genes = choose_random_set(ks, num_genes, rng)
+    keys = [ _key(i) for i in range(t) ]
+    set_weights = [ _weight(key) for key in keys ]
+    weight = sum(set_weights)
+    position = [-1] * num_genes
+    for p, g in enumerate(genes):
+        position[g] = p
+
+    # Run MCMC
+    samples, sample_weights = [], []
+    itera = state['itera']
+    last_itera = itera + niters
+    while itera < last_itera:
+        # Sample the next gene to swap in/around the set
+        next_gene = rng.randrange(num_genes)
+        p = position[next_gene]
+
+        # There are two possibilities for the next gene
+        # 1) The gene we sampled is already in the current solution. In this
+        #    case, we swap the gene with another gene in a different set.
+        if p != -1:
+            # if we only have one set, we can't swap between sets
+            if t == 1: continue
+            i = set_of[p]
+            q = rng.randrange(num_sampled_genes - ks[i])
+            if q >= offsets[i]:
+                q += ks[i]
+            j = set_of[q]
+            swap_gene = genes[q]
+            genes[p], genes[q] = swap_gene, next_gene
+            next_keys = [ _key(i), _key(j) ]
+            if not (_valid_set(next_keys[1]) and _valid_set(next_keys[0])):
+                genes[p], genes[q] = next_gene, swap_gene
+                continue
+            changed = [i, j]
+
+        # 2) The gene is not in the current solution. In this case, we choose
+        #    a random gene in the solution to remove, and add the next gene.
+        else:
+            q = rng.randrange(num_sampled_genes)
+            j = set_of[q]
+            swap_gene = genes[q]
+            genes[q] = next_gene
+            next_keys = [ _key(j) ]
+            if not _valid_set(next_keys[0]):
+                genes[q] = swap_gene
+                continue
+            changed = [j]
+
+        # Compare the current soln to the next soln, using only the weights
+        # of the changed sets
+        next_set_weights = [ _weight(key) for key in next_keys ]
+        next_weight = weight + sum(next_set_weights) - sum( set_weights[i] for i in changed )
+        if beta*_log_accept_ratio( weight, next_weight ) >= np.log10(rng.random()):
+            for i, key, w in zip(changed, next_keys, next_set_weights):
+                keys[i], set_weights[i] = key, w
+            weight = sum(set_weights)
+            if p != -1:
+                position[next_gene], position[swap_gene] = q, p
+            else:
+                position[swap_gene], position[next_gene] = -1, q
+        elif p != -1:
+            genes[p], genes[q] = next_gene, swap_gene
+        else:
+            genes[q] = swap_gene
+
+        # Freeze sets after thinning the chain a certain number of iterations
+        itera += 1
+        if (itera+1) % step_len == 0:
+            samples.append(tuple(sorted(keys)))
+            sample_weights.append(weight)
+
+    state = dict(genes=genes, weight=weight, itera=itera, beta=beta, rng_state=rng.getstate())
+    return state, samples, sample_weights, dict(_computedPvals), dict(_computedObs)
+
+# Choose a random set of gene indices to initialize with
+def choose_random_set(ks, num_genes, rng=None):
+    return (rng.sample if rng else sample)(range(num_genes), sum(ks))
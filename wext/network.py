@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# Load required modules
+import numpy as np
+from collections import defaultdict
+from itertools import islice
+
+# Load an interaction network from an edge list file, with the two genes of
+# an edge in the first two (tab or space separated) columns of each line.
+# Other columns and lines starting with # are ignored.
+def load_network( network_file ):
+    geneToNeighbors = defaultdict(set)
+    with open(network_file, 'r') as IN:
+        for l in IN:
+            if l.startswith('#') or not l.strip(): continue
+            u, v = l.split()[:2]
+            if u != v:
+                geneToNeighbors[u].add(v)
+                geneToNeighbors[v].add(u)
+    return geneToNeighbors
+
+# Neighbors of each gene in the network among the given genes, as sorted
+# lists of indices into the genes
+def network_neighbors( genes, geneToNeighbors ):
+    geneToIndex = dict( (g, i) for i, g in enumerate(genes) )
+    return [ sorted( geneToIndex[h] for h in geneToNeighbors.get(g, ()) if h in geneToIndex ) for g in genes ]
+
+# Iterate over the connected k-subsets of the vertices of a graph (given by
+# the neighbors of each vertex), as sorted tuples, using the ESU algorithm
+# (Wernicke, 2006). Each subset is extended from its smallest vertex v, only
+# by vertices larger than v that are neighbors of the last vertex added but
+# not of the earlier ones, so every connected subset is generated exactly
+# once, in a fixed order, and without storing the subsets generated so far.
+def connected_subgraphs( neighbors, k ):
+    def extend( sub, ext, closed, v ):
+        if len(sub) == k:
+            yield tuple(sorted(sub))
+            return
+        ext = list(ext)
+        while ext:
+            w = ext.pop()
+            w_ext = ext + [ u for u in neighbors[w] if u > v and u not in closed ]
+            for M in extend(sub + [w], w_ext, closed | set(neighbors[w]), v):
+                yield M
+
+    for v in range(len(neighbors)):
+        for M in extend([v], [ u for u in neighbors[v] if u > v ], set(neighbors[v]) | set([v]), v):
+            yield M
+
+def num_connected_subgraphs( neighbors, k ):
+    return sum( 1 for _ in connected_subgraphs(neighbors, k) )
+
+# Matrix of the connected k-subsets with ranks start, ..., stop-1 in the order
+# of connected_subgraphs
+def connected_set_matrix( neighbors, k, start=0, stop=None ):
+    sets = islice(connected_subgraphs(neighbors, k), start, stop)
+    return np.array(list(sets), dtype=np.int32).reshape(-1, k)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# Load required modules
+import os, json, struct, numpy as np
+
+# A permutation archive stores many permuted mutation matrices in a single
+# file. The file starts with a magic string, the length of a JSON header, and
+# the header itself (genes, patients, and the run parameters). The header is
+# followed by fixed-size records, one per permutation, each holding the seed
+# and the bit-packed genes x patients matrix. The records can therefore be
+# appended to and memory-mapped as a (permutations x genes x bytes) array.
+ARCHIVE_MAGIC   = b'WEXTPERM'
+ARCHIVE_VERSION = 1
+ARCHIVE_EXTENSION = '.wpa'
+
+# Popcount of each byte, used to count mutated patients in packed rows
+BYTE_POPCOUNT = np.array([ bin(i).count('1') for i in range(256) ], dtype=np.uint16)
+
+def is_permutation_archive( path ):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as IN:
+        return IN.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC
+
+def _record_dtype( num_genes, num_patients ):
+    row_bytes = (num_patients + 7) // 8
+    return np.dtype([('seed', '<i8'), ('matrix', 'u1', (num_genes, row_bytes))])
+
+def _read_header( IN ):
+    if IN.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+        raise ValueError('Not a permutation archive: {}'.format(IN.name))
+    header_len, = struct.unpack('<Q', IN.read(8))
+    header = json.loads(IN.read(header_len).decode('utf-8'))
+    header['offset'] = len(ARCHIVE_MAGIC) + 8 + header_len
+    return header
+
+# Create an empty archive for permutations of the given genes and patients
+def create_permutation_archive( archive_file, genes, patients, params=None ):
+    header = dict(version=ARCHIVE_VERSION, genes=list(genes), patients=list(patients),
+                  params=params)
+    encoded = json.dumps(header).encode('utf-8')
+    with open(archive_file, 'wb') as OUT:
+        OUT.write(ARCHIVE_MAGIC)
+        OUT.write(struct.pack('<Q', len(encoded)))
+        OUT.write(encoded)
+
+# Append permuted matrices to an archive. Each matrix is a (genes x patients)
+# boolean array in the order given by the archive header.
+def append_permutation_archive( archive_file, seeds, matrices ):
+    with open(archive_file, 'rb') as IN:
+        header = _read_header(IN)
+    dtype = _record_dtype(len(header['genes']), len(header['patients']))
+    with open(archive_file, 'ab') as OUT:
+        for seed, A in zip(seeds, matrices):
+            record = np.zeros(1, dtype=dtype)
+            record['seed'] = seed
+            record['matrix'][0] = np.packbits(np.asarray(A, dtype=bool), axis=1)
+            OUT.write(record.tobytes())
+
+# Truncate an archive to its first num_permutations records, e.g. to drop
+# the records appended after the last checkpoint of a run
+def truncate_permutation_archive( archive_file, num_permutations ):
+    with open(archive_file, 'r+b') as IN:
+        header = _read_header(IN)
+        dtype = _record_dtype(len(header['genes']), len(header['patients']))
+        size = header['offset'] + num_permutations*dtype.itemsize
+        if os.path.getsize(archive_file) < size:
+            raise ValueError('Permutation archive {} has fewer than {} permutations'.format(archive_file, num_permutations))
+        IN.truncate(size)
+
+# Load the header and a read-only memory map of the records of an archive.
+# Slicing the records reads only the requested permutations from disk.
+def load_permutation_archive( archive_file ):
+    with open(archive_file, 'rb') as IN:
+        header = _read_header(IN)
+    dtype = _record_dtype(len(header['genes']), len(header['patients']))
+    num_permutations = (os.path.getsize(archive_file) - header['offset']) // dtype.itemsize
+    if num_permutations == 0:
+        records = np.zeros(0, dtype=dtype)
+    else:
+        records = np.memmap(archive_file, dtype=dtype, mode='r', offset=header['offset'],
+                            shape=(num_permutations,))
+    return header, records
+
+# Compute the number of exclusive mutations T in each permutation of the
+# given chunk of packed matrices for the gene set with the given row indices
+def packed_exclusivity( packed, rows ):
+    once  = np.zeros((packed.shape[0], packed.shape[2]), dtype=np.uint8)
+    twice = np.zeros_like(once)
+    for i in rows:
+        twice |= once & packed[:, i]
+        once  |= packed[:, i]
+    return BYTE_POPCOUNT[once & ~twice].sum(axis=1, dtype=np.int64)
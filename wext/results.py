@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Load required modules
+import numpy as np
+
+# Results of testing gene sets are stored as columns instead of dictionaries
+# keyed by gene sets. Each gene set is a row of an int32 matrix of indices into
+# the sorted list of genes (padded with -1 when the sets have different sizes),
+# with float64 P-value, FDR and runtime columns, and int64 columns for the
+# observed values: T, Z, the mutation counts X (padded with 0) and the
+# contingency table tbl (padded with 0). Gene names are only used on output.
+RESULT_COLUMNS = ['sets', 'pval', 'fdr', 'runtime', 'T', 'Z', 'X', 'tbl']
+
+# Lists of results that are filled one gene set at a time by the workers
+def empty_result_columns():
+    return dict( (column, []) for column in RESULT_COLUMNS if column != 'fdr' )
+
+def append_result( columns, indices, pval, runtime, obs ):
+    X, T, Z, tbl = obs
+    columns['sets'].append(indices)
+    columns['pval'].append(pval)
+    columns['runtime'].append(runtime)
+    columns['T'].append(T)
+    columns['Z'].append(Z)
+    columns['X'].append(X)
+    columns['tbl'].append(tbl)
+
+def _padded( rows, width, fill, dtype ):
+    matrix = np.full((len(rows), width), fill, dtype=dtype)
+    for i, row in enumerate(rows):
+        matrix[i, :len(row)] = row
+    return matrix
+
+def results_from_columns( genes, k, columns, fdr=None ):
+    n = len(columns['pval'])
+    if n > 0 and all( len(row) == k for row in columns['sets'] ):
+        sets = np.array(columns['sets'], dtype=np.int32).reshape(n, k)
+        X    = np.array(columns['X'], dtype=np.int64).reshape(n, k)
+        tbl  = np.array(columns['tbl'], dtype=np.int64).reshape(n, 2**k)
+    else:
+        sets = _padded(columns['sets'], k, -1, np.int32)
+        X    = _padded(columns['X'], k, 0, np.int64)
+        tbl  = _padded(columns['tbl'], 2**k, 0, np.int64)
+    return dict(genes=list(genes), sets=sets, pval=np.array(columns['pval'], dtype=np.float64),
+                fdr=np.full(n, np.nan) if fdr is None else np.asarray(fdr, dtype=np.float64),
+                runtime=np.array(columns['runtime'], dtype=np.float64),
+                T=np.array(columns['T'], dtype=np.int64), Z=np.array(columns['Z'], dtype=np.int64),
+                X=X, tbl=tbl)
+
+# Convert results stored in dictionaries keyed by gene sets
+def results_from_dicts( genes, setToPval, setToRuntime, setToFDR, setToObs ):
+    geneToIndex = dict( (g, i) for i, g in enumerate(genes) )
+    sets = list(setToPval.keys())
+    k = max([ len(M) for M in sets ] + [0])
+    columns = empty_result_columns()
+    for M in sets:
+        append_result(columns, sorted( geneToIndex[g] for g in M ), setToPval[M], setToRuntime.get(M, 0.), setToObs[M])
+    return results_from_columns(genes, k, columns, fdr=[ setToFDR[M] for M in sets ] if setToFDR is not None else None)
+
+def num_results( results ):
+    return len(results['pval'])
+
+# Select the results with the given indices or mask
+def select_results( results, selection ):
+    selected = dict( (column, results[column][selection]) for column in RESULT_COLUMNS )
+    selected['genes'] = results['genes']
+    return selected
+
+# Concatenate results over the same genes
+def concatenate_results( results_list ):
+    results_list = list(results_list)
+    k = max( r['sets'].shape[1] for r in results_list )
+    concatenated = dict(genes=results_list[0]['genes'])
+    for column, fill in [('sets', -1), ('X', 0), ('tbl', 0)]:
+        width = k if column != 'tbl' else 2**k
+        concatenated[column] = np.concatenate([ np.pad(r[column], ((0, 0), (0, width - r[column].shape[1])),
+                                                       constant_values=fill) for r in results_list ])
+    for column in ['pval', 'fdr', 'runtime', 'T', 'Z']:
+        concatenated[column] = np.concatenate([ r[column] for r in results_list ])
+    return concatenated
+
+# Gene names and observed values (X, T, Z, tbl) of the i-th gene set
+def result_genes( results, i ):
+    return [ results['genes'][g] for g in results['sets'][i] if g >= 0 ]
+
+def result_observed( results, i ):
+    k = int(np.sum(results['sets'][i] >= 0))
+    return results['X'][i, :k].tolist(), int(results['T'][i]), int(results['Z'][i]), results['tbl'][i, :2**k].tolist()
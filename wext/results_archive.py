@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+# Load required modules
+import os, io, json, zipfile, tempfile, shutil, numpy as np
+from .results import *
+from .statistics import chunked_multiple_hypothesis_correction
+
+# A results archive stores columnar results (see results.py) in a NumPy .npz
+# (zip) file, so it can be written a chunk at a time and read without loading
+# every set. The archive holds the sorted genes (the dictionary that the gene
+# set indices refer to) and a JSON header with the run parameters, followed by
+# chunks of results. Each chunk stores its columns and a few statistics --
+# its smallest and largest P-value, its smallest FDR and a bitmask of the
+# genes in its sets -- so readers can skip chunks that cannot match a query
+# without reading their columns. When the results are written as they are
+# tested, the FDRs and statistics of the chunks are added once all the
+# P-values are known. MCMC archives also store the sampled collections, as
+# rows of indices into the sets in the chunks.
+RESULTS_ARCHIVE_EXTENSION = '.npz'
+RESULTS_CHUNK_SIZE = 100000
+
+def is_results_archive( path ):
+    if not os.path.isfile(path) or not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return 'header.npy' in archive.namelist()
+
+def _write_array( archive, name, array ):
+    buf = io.BytesIO()
+    np.lib.format.write_array(buf, np.asanyarray(array), allow_pickle=False)
+    archive.writestr(name + '.npy', buf.getvalue())
+
+def _chunk_names( names ):
+    return sorted(set( name.split('/')[0] for name in names if name.startswith('chunk') ))
+
+# Create an empty archive for results over the given genes
+def create_results_archive( archive_file, genes, params=None ):
+    with zipfile.ZipFile(archive_file, 'w', allowZip64=True) as archive:
+        _write_array(archive, 'header', np.array(json.dumps(dict(params=params))))
+        _write_array(archive, 'genes', np.array(list(genes), dtype=str))
+
+def _write_chunk_stats( archive, name, pval, fdr ):
+    stats = np.array([ np.fmin.reduce(pval), np.fmax.reduce(pval), np.fmin.reduce(fdr) ])
+    _write_array(archive, '{}/stats'.format(name), stats)
+
+# Append results to an archive, in chunks of at most chunk_size sets. The
+# results should be over the genes of the archive, and sorting them by
+# P-value first makes the chunk statistics more selective. Results whose FDRs
+# are not known yet, because they are written as they are tested, are
+# appended with with_fdr=False, and their FDRs are computed over all the
+# sets of the archive by correct_results_archive once the last ones are in.
+def append_results_archive( archive_file, results, chunk_size=RESULTS_CHUNK_SIZE, with_fdr=True ):
+    with zipfile.ZipFile(archive_file, 'a', allowZip64=True) as archive:
+        num_genes = len(np.load(io.BytesIO(archive.read('genes.npy'))))
+        num_chunks = len(_chunk_names(archive.namelist()))
+        for start in range(0, num_results(results), chunk_size):
+            chunk = select_results(results, slice(start, start+chunk_size))
+            name = 'chunk{:08d}'.format(num_chunks)
+            for column in RESULT_COLUMNS:
+                if column != 'fdr' or with_fdr:
+                    _write_array(archive, '{}/{}'.format(name, column), chunk[column])
+            gene_mask = np.zeros(num_genes, dtype=bool)
+            gene_mask[chunk['sets'][chunk['sets'] >= 0]] = True
+            _write_array(archive, '{}/gene_mask'.format(name), np.packbits(gene_mask))
+            if with_fdr:
+                _write_chunk_stats(archive, name, chunk['pval'], chunk['fdr'])
+            num_chunks += 1
+
+# Add the collections sampled by MCMC to an archive. The collections index
+# the sets in the order they were appended, so they refer to the results
+# loaded without any filters.
+def append_collections_archive( archive_file, collections ):
+    with zipfile.ZipFile(archive_file, 'a', allowZip64=True) as archive:
+        _write_array(archive, 'collections/sets', collections['sets'])
+        _write_array(archive, 'collections/freq', collections['freq'])
+
+def load_results_header( archive_file ):
+    with np.load(archive_file) as data:
+        header = json.loads(data['header'].item())
+        header['genes'] = data['genes'].tolist()
+        header['num_chunks'] = len(_chunk_names(data.files))
+    return header
+
+# Iterate over the chunks of results in an archive, keeping only the sets with
+# P-value at most max_pval, FDR at most max_fdr, and at least one gene in
+# genes. Chunks that cannot contain such sets are skipped without reading
+# their columns.
+def iter_results_archive( archive_file, max_pval=None, max_fdr=None, genes=None ):
+    with np.load(archive_file) as data:
+        archive_genes = data['genes'].tolist()
+        if genes is not None:
+            geneToIndex = dict( (g, i) for i, g in enumerate(archive_genes) )
+            gene_indices = [ geneToIndex[g] for g in genes if g in geneToIndex ]
+            query_mask = np.zeros(len(archive_genes), dtype=bool)
+            query_mask[gene_indices] = True
+        for name in _chunk_names(data.files):
+            min_pval, _, min_fdr = data['{}/stats'.format(name)]
+            if max_pval is not None and not min_pval <= max_pval: continue
+            if max_fdr is not None and not min_fdr <= max_fdr: continue
+            if genes is not None:
+                gene_mask = np.unpackbits(data['{}/gene_mask'.format(name)])[:len(archive_genes)].astype(bool)
+                if not np.any(gene_mask & query_mask): continue
+
+            chunk = dict( (column, data['{}/{}'.format(name, column)]) for column in RESULT_COLUMNS )
+            chunk['genes'] = archive_genes
+            keep = np.ones(num_results(chunk), dtype=bool)
+            if max_pval is not None:
+                keep &= chunk['pval'] <= max_pval
+            if max_fdr is not None:
+                keep &= chunk['fdr'] <= max_fdr
+            if genes is not None:
+                keep &= np.any(np.in1d(chunk['sets'], gene_indices).reshape(chunk['sets'].shape), axis=1)
+            if np.any(keep):
+                yield select_results(chunk, keep)
+
+# Load the matching results of an archive into a single container
+def load_results_archive( archive_file, max_pval=None, max_fdr=None, genes=None ):
+    chunks = list(iter_results_archive(archive_file, max_pval, max_fdr, genes))
+    if chunks:
+        return concatenate_results(chunks)
+    return results_from_columns(load_results_header(archive_file)['genes'], 0, empty_result_columns())
+
+# Compute the FDRs of the sets in the given archives over all of them with
+# chunked_multiple_hypothesis_correction, so that their P-values are never all
+# in memory. The P-values and FDRs of each chunk are spilled to .npy files in
+# spill_dir. Returns the (archive file, chunk name, P-value file, FDR file) of
+# each chunk, in the order of the archives and of their chunks.
+def correct_archive_chunks( archive_files, spill_dir, method='BY' ):
+    chunks = []
+    for archive_file in archive_files:
+        with np.load(archive_file) as data:
+            for name in _chunk_names(data.files):
+                pvalue_file = os.path.join(spill_dir, 'pval-{}.npy'.format(len(chunks)))
+                fdr_file = os.path.join(spill_dir, 'fdr-{}.npy'.format(len(chunks)))
+                np.save(pvalue_file, data['{}/pval'.format(name)])
+                chunks.append((archive_file, name, pvalue_file, fdr_file))
+    chunked_multiple_hypothesis_correction([ c[2] for c in chunks ], [ c[3] for c in chunks ], method, tmp_dir=spill_dir)
+    return chunks
+
+# Compute the FDRs of the sets of an archive that were appended without them,
+# and add them to its chunks with the chunk statistics
+def correct_results_archive( archive_file, method='BY', tmp_dir=None ):
+    spill_dir = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        chunks = correct_archive_chunks([archive_file], spill_dir, method)
+        with zipfile.ZipFile(archive_file, 'a', allowZip64=True) as archive:
+            for _, name, pvalue_file, fdr_file in chunks:
+                fdr = np.load(fdr_file)
+                _write_array(archive, '{}/fdr'.format(name), fdr)
+                _write_chunk_stats(archive, name, np.load(pvalue_file), fdr)
+    finally:
+        shutil.rmtree(spill_dir)
@@ -35,6 +35,8 @@ setup(name='comet_exact_tests', version='0.0.1',  ext_modules=[module],
 ## Compile the FORTRAN extension, bipartite_edge_swap_module
 srcs = ['/src/fortran/bipartite_edge_swap_module.f95']
 module = Extension('bipartite_edge_swap_module', include_dirs=[numpy.get_include()],
-    sources = [ thisDir + s for s in srcs ])
+    sources = [ thisDir + s for s in srcs ],
+    extra_f90_compile_args = ['-fopenmp'],
+    extra_link_args = ['-fopenmp'])
 setup(name='bipartite_edge_swap_module', version='0.0.1',  ext_modules=[module],
       description='FORTRAN code description')
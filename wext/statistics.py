@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import numpy as np
+import os, tempfile, shutil, numpy as np
 
 def multiple_hypothesis_correction(p_values_, method='BH'):
     """
@@ -21,42 +21,197 @@ def multiple_hypothesis_correction(p_values_, method='BH'):
     if method not in ['bonferroni', 'BH', 'BY']:
         raise NotImplementedError('{} method not implemented'.format(method))
 
-    valid_indices = [i for i, p_value in enumerate(p_values_) if 0.0<=p_value<=1.0]
-    invalid_indices = [i for i, p_value in enumerate(p_values_) if not 0.0<=p_value<=1.0]
+    p_values_ = np.asarray(p_values_, dtype=np.float64)
+    valid = (0.0 <= p_values_) & (p_values_ <= 1.0)
 
-    p_values = np.asarray(p_values_)[valid_indices]
+    p_values = p_values_[valid]
     n = len(p_values)
 
     if method=='bonferroni':
         q_values = np.minimum(n*p_values, 1)
 
-    elif method=='BH':
+    else:
+        # The q-value of the i-th smallest P-value is the minimum of
+        # c*n/j*p_(j) over j >= i (and 1), where c=1 for BH
+        c = harmonic_number(n) if method=='BY' else 1.0
         sorted_indices = np.argsort(p_values)
         sorted_p_values = p_values[sorted_indices]
-
-        sorted_q_values = np.zeros(n)
-        sorted_q_values[n-1] = min(sorted_p_values[n-1], 1.0)
-        for i in reversed(range(n-1)):
-            sorted_q_values[i] = min(float(n)/float(i+1)*sorted_p_values[i], sorted_q_values[i+1])
+        sorted_q_values = c*float(n)/np.arange(1, n+1, dtype=np.float64)*sorted_p_values
+        sorted_q_values = np.minimum(np.minimum.accumulate(sorted_q_values[::-1])[::-1], 1.0)
 
         q_values = np.zeros(n)
         q_values[sorted_indices] = sorted_q_values
 
-    elif method=='BY':
-        sorted_indices = np.argsort(p_values)
-        sorted_p_values = p_values[sorted_indices]
+    q_values_ = np.zeros(len(p_values_))
+    q_values_[valid] = q_values
+    q_values_[~valid] = float('nan')
 
-        c = np.sum(1.0/np.arange(1, n+1, dtype=np.float64))
-        sorted_q_values = np.zeros(n)
-        sorted_q_values[n-1] = min(c*sorted_p_values[n-1], 1.0)
-        for i in reversed(range(n-1)):
-            sorted_q_values[i] = min(c*(float(n)/float(i+1))*sorted_p_values[i], sorted_q_values[i+1])
+    return q_values_
 
-        q_values = np.zeros(n)
-        q_values[sorted_indices] = sorted_q_values
+# Compute the harmonic number 1 + 1/2 + ... + 1/n in blocks
+def harmonic_number(n, block_size=10**7):
+    return sum( np.sum(1.0/np.arange(i, min(i+block_size, n+1), dtype=np.float64))
+                for i in range(1, n+1, block_size) )
 
-    q_values_ = np.zeros(len(p_values_))
-    q_values_[valid_indices] = q_values
-    q_values_[invalid_indices] = float('nan')
+# Bin P-values on a fine log scale (with P=0 in the first bin), so that the
+# bins are ordered by P-value
+NUM_LOG_BINS = 33001
+def log_bins(p_values):
+    with np.errstate(divide='ignore'):
+        bins = np.floor((np.log10(p_values) + 330.)*100.)
+    return np.clip(np.where(np.isneginf(bins), 0., bins), 0, NUM_LOG_BINS-1).astype(np.int64)
 
-    return q_values_
+def chunked_multiple_hypothesis_correction(pvalue_files, qvalue_files, method='BH', max_bucket_size=10**7,
+                                           chunk_size=10**7, tmp_dir=None):
+    """
+    Compute the same multiple-hypothesis correction as
+    multiple_hypothesis_correction for P-values stored in chunks (.npy files)
+    that do not fit in memory together, writing the q-values of each chunk to
+    the corresponding file in qvalue_files.
+
+    The P-values are first counted in fine log-scale bins, which are grouped
+    into buckets of at most about max_bucket_size P-values. The P-values are
+    then spilled to one file per bucket, and the buckets processed from the
+    largest P-values down, so that each bucket fits in memory and the running
+    minimum of the q-values is carried from one bucket to the next.
+    """
+    if method not in ['bonferroni', 'BH', 'BY']:
+        raise NotImplementedError('{} method not implemented'.format(method))
+
+    def _chunks():
+        offset = 0
+        for pvalue_file in pvalue_files:
+            p_values_ = np.load(pvalue_file, mmap_mode='r')
+            for start in range(0, len(p_values_), chunk_size):
+                p_values = np.asarray(p_values_[start:start+chunk_size], dtype=np.float64)
+                valid = (0.0 <= p_values) & (p_values <= 1.0)
+                yield offset + start + np.flatnonzero(valid), p_values[valid]
+            offset += len(p_values_)
+
+    # Pass 1: count the valid P-values in each bin, and create the output
+    # files (invalid P-values have NaN q-values)
+    counts = np.zeros(NUM_LOG_BINS, dtype=np.int64)
+    for _, p_values in _chunks():
+        counts += np.bincount(log_bins(p_values), minlength=NUM_LOG_BINS)
+    n = int(counts.sum())
+
+    sizes = [ len(np.load(pvalue_file, mmap_mode='r')) for pvalue_file in pvalue_files ]
+    offsets = np.cumsum([0] + sizes)
+    q_values_ = [ np.lib.format.open_memmap(qvalue_file, mode='w+', dtype=np.float64, shape=(size,))
+                  for qvalue_file, size in zip(qvalue_files, sizes) ]
+    for q_values in q_values_:
+        q_values[:] = float('nan')
+
+    def _write(indices, q_values):
+        files = np.searchsorted(offsets, indices, side='right') - 1
+        for f in np.unique(files):
+            in_file = files == f
+            q_values_[f][indices[in_file] - offsets[f]] = q_values[in_file]
+
+    if method == 'bonferroni':
+        for indices, p_values in _chunks():
+            _write(indices, np.minimum(n*p_values, 1))
+
+    else:
+        # Pass 2: spill the (index, P-value) pairs into buckets of consecutive bins
+        bin_to_bucket = (np.cumsum(counts) - counts) // max_bucket_size
+        bucket_dtype = np.dtype([('index', '<i8'), ('p', '<f8')])
+        spill_dir = tempfile.mkdtemp(dir=tmp_dir)
+        try:
+            bucket_file = os.path.join(spill_dir, 'bucket-{}.bin').format
+            for indices, p_values in _chunks():
+                buckets = bin_to_bucket[log_bins(p_values)]
+                for b in np.unique(buckets):
+                    in_bucket = buckets == b
+                    records = np.zeros(int(np.sum(in_bucket)), dtype=bucket_dtype)
+                    records['index'], records['p'] = indices[in_bucket], p_values[in_bucket]
+                    with open(bucket_file(b), 'ab') as OUT:
+                        OUT.write(records.tobytes())
+
+            # Pass 3: process the buckets from the largest P-values down,
+            # ranking ties by the largest rank
+            c = harmonic_number(n) if method=='BY' else 1.0
+            bucket_counts = np.bincount(bin_to_bucket, weights=counts).astype(np.int64)
+            num_below = np.cumsum(bucket_counts) - bucket_counts
+            running_min = 1.0
+            for b in reversed(range(len(bucket_counts))):
+                if bucket_counts[b] == 0:
+                    continue
+                records = np.fromfile(bucket_file(b), dtype=bucket_dtype)
+                records.sort(order='p')
+                sorted_p_values = records['p']
+                ranks = num_below[b] + np.searchsorted(sorted_p_values, sorted_p_values, side='right')
+                sorted_q_values = c*float(n)/ranks*sorted_p_values
+                sorted_q_values = np.minimum(np.minimum.accumulate(sorted_q_values[::-1])[::-1], running_min)
+                running_min = sorted_q_values[0]
+                _write(records['index'], sorted_q_values)
+        finally:
+            shutil.rmtree(spill_dir)
+
+    for q_values in q_values_:
+        q_values.flush()
+
+def sorted_multiple_hypothesis_correction(p_values, q_values, method='BH', chunk_size=10**7):
+    """
+    Compute the same multiple-hypothesis correction as
+    multiple_hypothesis_correction for valid P-values that are already sorted
+    in ascending order, writing the q-values to q_values. Both arrays can be
+    memory-mapped, since they are processed in chunks from the largest
+    P-values down, carrying the running minimum of the q-values.
+    """
+    if method not in ['bonferroni', 'BH', 'BY']:
+        raise NotImplementedError('{} method not implemented'.format(method))
+
+    n = len(p_values)
+    c = harmonic_number(n) if method=='BY' else 1.0
+    running_min = 1.0
+    for stop in range(n, 0, -chunk_size):
+        start = max(stop - chunk_size, 0)
+        sorted_p_values = np.asarray(p_values[start:stop], dtype=np.float64)
+        if method == 'bonferroni':
+            q_values[start:stop] = np.minimum(n*sorted_p_values, 1)
+            continue
+        sorted_q_values = c*float(n)/np.arange(start+1, stop+1, dtype=np.float64)*sorted_p_values
+        sorted_q_values = np.minimum(np.minimum.accumulate(sorted_q_values[::-1])[::-1], running_min)
+        running_min = sorted_q_values[0]
+        q_values[start:stop] = sorted_q_values
+
+# Upper edge of each of the log-scale bins
+def _log_bin_upper_edges():
+    return np.minimum(10.**((np.arange(NUM_LOG_BINS) + 1.)/100. - 330.), 1.0)
+
+def bounded_multiple_hypothesis_correction(p_values, dropped_counts, method='BH'):
+    """
+    Compute conservative q-values for the given (valid) P-values when the
+    remaining P-values were dropped, and only counted in the log-scale bins of
+    log_bins (dropped_counts). The dropped P-values must be at least as large
+    as the given ones, as when we only keep the smallest P-values.
+
+    The q-value of the i-th smallest P-value is the minimum of c*n/j*p_(j)
+    over j >= i. The dropped P-values enter through their bins: the largest
+    P-value in bin b is below the upper edge u_b of the bin, and has rank equal
+    to the number of P-values up to that bin, which bounds its term. The
+    resulting q-values are therefore never smaller than the exact ones.
+    """
+    if method not in ['bonferroni', 'BH', 'BY']:
+        raise NotImplementedError('{} method not implemented'.format(method))
+
+    p_values = np.asarray(p_values, dtype=np.float64)
+    num_kept = len(p_values)
+    n = num_kept + int(np.sum(dropped_counts))
+
+    if method=='bonferroni':
+        return np.minimum(n*p_values, 1)
+
+    c = harmonic_number(n) if method=='BY' else 1.0
+    nonempty = np.flatnonzero(dropped_counts)
+    ranks = num_kept + np.cumsum(dropped_counts)[nonempty]
+    tail_min = min(1.0, np.min(c*float(n)/ranks*_log_bin_upper_edges()[nonempty])) if len(nonempty) else 1.0
+
+    sorted_indices = np.argsort(p_values)
+    sorted_q_values = c*float(n)/np.arange(1, num_kept+1, dtype=np.float64)*p_values[sorted_indices]
+    sorted_q_values = np.minimum(np.minimum.accumulate(sorted_q_values[::-1])[::-1], tail_min)
+
+    q_values = np.zeros(num_kept)
+    q_values[sorted_indices] = sorted_q_values
+    return q_values
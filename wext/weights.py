@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# Load required modules
+import os, warnings, numpy as np
+
+# Group the rows and columns of a genes x patients matrix by their marginals
+# (number of mutations). Entries with the same pair of row and column
+# marginals form a class, indexed by (row class, column class).
+def marginal_classes(r, s):
+    row_marginals, row_classes = np.unique(r, return_inverse=True)
+    col_marginals, col_classes = np.unique(s, return_inverse=True)
+    return row_marginals, row_classes, col_marginals, col_classes
+
+# Number of entries in each class
+def class_sizes(row_classes, col_classes):
+    return np.outer(np.bincount(row_classes), np.bincount(col_classes))
+
+# Sum the entries of P in each class
+def class_sums(P, row_classes, col_classes):
+    row_sums = np.zeros((row_classes.max()+1, np.shape(P)[1]))
+    np.add.at(row_sums, row_classes, P)
+    sums = np.zeros((row_classes.max()+1, col_classes.max()+1))
+    np.add.at(sums.T, col_classes, row_sums.T)
+    return sums
+
+# Compute the largest relative standard error of the class means over batches
+# of permutations, given the class means of each batch. Classes with a zero
+# mean (e.g. genes that are never mutated) are ignored.
+def max_relative_error(batch_class_means):
+    num_batches = len(batch_class_means)
+    if num_batches < 2:
+        return float('inf')
+    means = np.mean(batch_class_means, axis=0)
+    std_errors = np.std(batch_class_means, axis=0, ddof=1)/np.sqrt(num_batches)
+    nonzero = means > 0
+    if not np.any(nonzero):
+        return 0.
+    return np.max(std_errors[nonzero]/means[nonzero])
+
+# The raw counts behind a weights file are stored next to it, so that later
+# runs can add permutations and update the weights
+def weight_counts_file(weights_file):
+    if weights_file.endswith('.npy'):
+        weights_file = weights_file[:-len('.npy')]
+    return weights_file + '-counts.npz'
+
+def save_weight_counts(weights_file, counts, num_permutations, genes, patients, seed=None, swap_multiplier=None,
+                       thin_multiplier=None, min_frequency=None):
+    np.savez(weight_counts_file(weights_file), counts=counts, num_permutations=num_permutations,
+             genes=np.array(genes, dtype=str), patients=np.array(patients, dtype=str),
+             seed=-1 if seed is None else seed,
+             swap_multiplier=-1 if swap_multiplier is None else swap_multiplier,
+             thin_multiplier=-1 if thin_multiplier is None else thin_multiplier,
+             min_frequency=-1 if min_frequency is None else min_frequency)
+
+def load_weight_counts(weights_file):
+    with np.load(weight_counts_file(weights_file)) as data:
+        weight_counts = dict(counts=data['counts'], num_permutations=int(data['num_permutations']),
+                             genes=list(data['genes']), patients=list(data['patients']))
+        for key in ['seed', 'swap_multiplier', 'thin_multiplier', 'min_frequency']:
+            weight_counts[key] = None if data[key] == -1 else data[key].item()
+    return weight_counts
+
+# Minimum number of mutations of the genes whose weights were estimated (the
+# weights of the other genes are uniform across patients), or None if the
+# weights file has no counts stored with it
+def weights_min_frequency(weights_file):
+    if not os.path.isfile(weight_counts_file(weights_file)):
+        return None
+    with np.load(weight_counts_file(weights_file)) as data:
+        return None if data['min_frequency'] == -1 else int(data['min_frequency'])
+
+# Estimate the weights analytically as the maximum entropy distribution over
+# binary matrices with the expected marginals r and s, i.e.
+# P_ij = x_i y_j / (1 + x_i y_j). Entries with the same marginals have the
+# same weight, so we fit x and y on the grid of marginal classes.
+def maxent_weight_matrix(r, s, tol=1e-10, max_iter=100000):
+    m, n = len(r), len(s)
+    row_marginals, row_classes, col_marginals, col_classes = marginal_classes(r, s)
+    row_counts = np.bincount(row_classes).astype(np.float64)
+    col_counts = np.bincount(col_classes).astype(np.float64)
+
+    # Entries of empty or full rows/columns are fixed at zero or one
+    free_rows = (row_marginals > 0) & (row_marginals < n)
+    free_cols = (col_marginals > 0) & (col_marginals < m)
+    Q = np.full((len(row_marginals), len(col_marginals)), np.nan)
+    Q[row_marginals == 0] = 0.
+    Q[row_marginals == n] = 1.
+    Q[:, col_marginals == 0] = 0.
+    Q[:, col_marginals == m] = 1.
+    fixed = np.nan_to_num(Q)
+
+    # Fit the remaining entries to the marginals left after the fixed entries
+    row_targets = row_marginals[free_rows] - np.dot(fixed[free_rows], col_counts)
+    col_targets = col_marginals[free_cols] - np.dot(row_counts, fixed[:, free_cols])
+    row_counts, col_counts = row_counts[free_rows], col_counts[free_cols]
+    if len(row_targets) > 0 and len(col_targets) > 0:
+        total = np.dot(row_counts, row_targets)
+        x = row_targets/np.sqrt(total)
+        y = col_targets/np.sqrt(total)
+        for _ in range(max_iter):
+            x = row_targets/np.dot(y/(1. + np.outer(x, y)), col_counts)
+            y = col_targets/np.dot(row_counts, x[:, None]/(1. + np.outer(x, y)))
+            xy = np.outer(x, y)
+            F = xy/(1. + xy)
+            error = np.max(np.abs(np.dot(F, col_counts) - row_targets))
+            if error < tol:
+                break
+        else:
+            warnings.warn('Maximum entropy weights did not converge in {} iterations (maximum row marginal error {}, '\
+                          'tolerance {})'.format(max_iter, error, tol), RuntimeWarning)
+        Q[np.ix_(free_rows, free_cols)] = F
+
+    return Q[row_classes][:, col_classes]
+
+# Summarize the differences between two weight matrices
+def compare_weight_matrices(P, Q):
+    diff = np.abs(P - Q)
+    nonzero = np.maximum(P, Q) > 0
+    return dict(max_abs_diff=float(diff.max()), mean_abs_diff=float(diff.mean()),
+                max_rel_diff=float(np.max(diff[nonzero]/np.maximum(P, Q)[nonzero])) if np.any(nonzero) else 0.,
+                correlation=float(np.corrcoef(P.flatten(), Q.flatten())[0, 1]))
+
+# Average the weights over entries with the same marginals. Also returns the
+# class lookup: the marginals of each row and column class, and the class of
+# each row and column, so that the weight of entry (i, j) is
+# P_class[row_classes[i], col_classes[j]].
+def postprocess_weight_matrix(P, r, s):
+    assert np.shape(P)==(len(r), len(s))
+    row_marginals, row_classes, col_marginals, col_classes = marginal_classes(r, s)
+    P_class = class_sums(P, row_classes, col_classes)/class_sizes(row_classes, col_classes)
+    lookup = dict(P_class=P_class, row_marginals=row_marginals, row_classes=row_classes,
+                  col_marginals=col_marginals, col_classes=col_classes)
+    return P_class[row_classes][:, col_classes], lookup